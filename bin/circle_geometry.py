@@ -0,0 +1,31 @@
+'''
+Geometry of states laid out evenly on a circle, shared by the layout search in
+generate.py and the config generation in static/json/generate_trial.py.
+'''
+import functools
+import collections
+import numpy as np
+
+CircleGeometry = collections.namedtuple('CircleGeometry', ['xy', 'distances'])
+
+@functools.lru_cache(maxsize=None)
+def circle_geometry(n):
+    '''
+    Returns the coordinates of each of the n positions on the circle (matching
+    circleXY in graphs.js) and the matrix of Euclidean distances between positions.
+    These are cached and shared, so they are read-only.
+
+    >>> g = circle_geometry(4)
+    >>> g.xy.round(3).tolist()
+    [[1.0, 0.5], [0.5, 1.0], [0.0, 0.5], [0.5, 0.0]]
+    >>> g.distances[0].round(3).tolist()
+    [0.0, 0.707, 1.0, 0.707]
+    >>> circle_geometry(4) is g
+    True
+    '''
+    angle = 2*np.pi/n*np.arange(n)
+    xy = (np.stack([np.cos(angle), np.sin(angle)], axis=-1) + 1)/2
+    distances = np.linalg.norm(xy[:, None, :] - xy[None, :, :], axis=-1)
+    xy.flags.writeable = False
+    distances.flags.writeable = False
+    return CircleGeometry(xy, distances)
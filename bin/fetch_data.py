@@ -1,11 +1,29 @@
 #!env/bin/python
 import os
+import sys
 import subprocess
 import pandas as pd
 from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter
 import hashlib
 import json
+import csv
+import traceback
+import shutil
+import itertools
+from collections import deque, namedtuple
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing import Pool
 from datetime import datetime
+try:
+    from orjson import loads as json_loads
+except ImportError:
+    json_loads = json.loads
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
 
 # set environment parameters so that we use the remote database
 
@@ -20,16 +38,22 @@ def get_database():
             f.write(url)
             return url
 
-env = os.environ
-env["PORT"] = ""
-env["ON_CLOUD"] = "1"
-env["DATABASE_URL"] = get_database()
+def connect_database():
+    """
+    Points psiTurk at the remote database. This runs from main rather than on
+    import, since the worker processes in parse_trials import this module again.
+    psiTurk's modules must only be imported after this.
+    """
+    env = os.environ
+    env["PORT"] = ""
+    env["ON_CLOUD"] = "1"
+    env["DATABASE_URL"] = get_database()
 
-from psiturk.models import Participant  # must be imported after setting params
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
 
 class Anonymizer(object):
-    def __init__(self):
-        self.mapping = {}
+    def __init__(self, mapping=None):
+        self.mapping = dict(mapping or {})
 
     def __call__(self, uniqueid):
         worker_id, assignment_id = uniqueid.split(':')
@@ -38,65 +62,295 @@ class Anonymizer(object):
         return self.mapping[worker_id]
 
 
-def write_csvs(version, debug):
-    ps = Participant.query.filter(Participant.codeversion == version).all()
-    if not debug:
-        ps = [p for p in ps if 'debug' not in p.uniqueid]
-    print(len(ps), 'participants')
-
-    anonymize = Anonymizer()
+def fetch_data(uniqueid):
+    """
+    Parsed datastring for one participant, including any trial records saved
+    through /sync/<uid>/append. Safe to call from any thread.
+    """
+    from psiturk.models import Participant
+    from psiturk.db import db_session
+    from participant_queries import reconcile
+    try:
+        datastring = (
+            Participant.query
+            .with_entities(Participant.datastring)
+            .filter(Participant.uniqueid == uniqueid)
+            .scalar()
+        )
+        try:
+            return reconcile(uniqueid, json.loads(datastring))
+        except (TypeError, ValueError):
+            print("No data found for", uniqueid)
+            return {}
+    finally:
+        # hand this thread's connection back to the pool
+        db_session.remove()
+
+
+def bounded_map(fn, xs, threads, max_pending):
+    """
+    Like ThreadPoolExecutor.map, but only keeps max_pending results in flight
+    (map submits everything up front, holding every result in memory).
+    """
+    with ThreadPoolExecutor(threads) as pool:
+        pending = deque()
+        for x in xs:
+            pending.append(pool.submit(fn, x))
+            if len(pending) >= max_pending:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+# These produce the same rows as Participant.get_*_data in
+# https://github.com/NYUCCL/psiTurk/blob/master/psiturk/models.py
+# but from an already parsed datastring.
+
+def trial_rows(wid, p, data):
+    for trial in data.get('data', []):
+        yield wid, trial['current_trial'], trial['dateTime'], json.dumps(trial['trialdata'])
+
+def event_rows(wid, p, data):
+    for event in data.get('eventdata', []):
+        yield wid, event['eventtype'], event['interval'], event['value'], event['timestamp']
+
+def question_rows(wid, p, data):
+    for question, answer in data.get('questiondata', {}).items():
+        yield wid, question, answer
+    # A hack: to avoid needing to attach condition and other metadata to
+    # every participant's qdata, we just sprinkle it in here from the DB.
+    yield wid, 'condition', p.cond
+    yield wid, 'counterbalance', p.counterbalance
+    yield wid, 'status', p.status
+
+
+def merge_csv(path, new_path, replaced):
+    """
+    Replaces path with its rows for participants not in `replaced`, followed
+    by every row of new_path (which is removed).
+    """
+    tmp = path + '.tmp'
+    with open(tmp, 'w', newline='') as out:
+        if os.path.isfile(path):
+            writer = csv.writer(out, lineterminator='\n')
+            with open(path, newline='') as f:
+                writer.writerows(row for row in csv.reader(f) if row[0] not in replaced)
+        with open(new_path, newline='') as f:
+            shutil.copyfileobj(f, out)
+    os.replace(tmp, path)
+    os.remove(new_path)
+
+
+def write_csvs(version, debug, threads=8, incremental=False):
+    """
+    Exports participants to data/human_raw/{version}/. With incremental=True,
+    only participants who changed since the last export (see watermark.json)
+    are fetched, and their rows replace any they had in the existing files.
+
+    "Changed" means began or ended since then, or is still unfinished and began
+    at most a day before (see query_participants). Status changes after the end
+    of the HIT (e.g. approvals and bonuses) are not tracked, so the status column
+    can be stale; run a full export to refresh it.
+    """
+    from participant_queries import iter_participants
+    outdir = os.path.join('data/human_raw', version)
+    os.makedirs(outdir, exist_ok=True)
+    watermark_file = os.path.join(outdir, 'watermark.json')
+    identifiers_file = os.path.join(outdir, "identifiers.csv")
+
+    since = None
+    mapping = None
+    if incremental and os.path.isfile(watermark_file):
+        with open(watermark_file) as f:
+            since = datetime.fromisoformat(json.load(f)['since'])
+        mapping = pd.read_csv(identifiers_file, dtype=str).set_index('workerid').wid.to_dict()
+        print('Fetching participants changed since', since)
 
     # Note: we don't filter by completion status.
+    ps = iter_participants(['uniqueid', 'cond', 'counterbalance', 'status', 'beginhit', 'endhit'],
+                           codeversion=version, debug=debug, changed_since=since)
+
+    def fetch(p):
+        return p, fetch_data(p.uniqueid)
 
-    def qdata(p):
-        '''
-        A hack: to avoid needing to attach condition and other metadata to
-        every participant's qdata, we just sprinkle it in here from the DB.
-        '''
-        rows = p.get_question_data()
-        if rows:
-            assert rows[-1] == '\n'
-        rows += f'{p.uniqueid},condition,{p.cond}\n'
-        rows += f'{p.uniqueid},counterbalance,{p.counterbalance}\n'
-        rows += f'{p.uniqueid},status,{p.status}\n'
-        return rows
-
-    # https://github.com/NYUCCL/psiTurk/blob/master/psiturk/models.py
+    anonymize = Anonymizer(mapping)
     contents = {
-        "trialdata": lambda p: p.get_trial_data(),
-        "eventdata": lambda p: p.get_event_data(),
-        "questiondata": qdata,
+        "trialdata": trial_rows,
+        "eventdata": event_rows,
+        "questiondata": question_rows,
     }
 
-    for filename in ["trialdata", "eventdata", "questiondata"]:
-
-        data = []
-        for p in ps:
-            try:
-                data.append(contents[filename](p))
-            except:
-                import traceback
-                traceback.print_exc()
-        data = "".join(data)
-
-        # write out the data file
-
-        dest = os.path.join('data/human_raw', version, "{}.csv".format(os.path.splitext(filename)[0]))
-        if not os.path.exists(os.path.dirname(dest)):
-            os.makedirs(os.path.dirname(dest), exist_ok=True)
-        with open(dest, "w") as fh:
-            fh.write(data)
-
-        # Anonymize PIDs
-        df = pd.read_csv(dest, header=None)
-        df[0] = df[0].map(anonymize)
-        df.to_csv(dest, header=None, index=False)
-
-    fp = os.path.join('data/human_raw', version, "identifiers.csv")
-    pd.Series(anonymize.mapping, name='wid').to_csv(fp, index_label='workerid')
+    # In incremental mode we write the changed participants to .new files and
+    # merge them into the existing ones at the end.
+    suffix = '.new' if since else ''
+    files = {filename: open(os.path.join(outdir, f"{filename}.csv{suffix}"), "w", newline='')
+             for filename in contents}
+    fetched = set()
+    latest = since
+    try:
+        writers = {filename: csv.writer(f, lineterminator='\n') for filename, f in files.items()}
+        # Datastrings are fetched and parsed in worker threads while we write.
+        for p, data in bounded_map(fetch, ps, threads, 4 * threads):
+            wid = anonymize(p.uniqueid)
+            fetched.add(wid)
+            latest = max(t for t in (latest, p.beginhit, p.endhit) if t is not None)
+            for filename, rows in contents.items():
+                try:
+                    writers[filename].writerows(list(rows(wid, p, data)))
+                except (KeyError, TypeError, AttributeError):
+                    traceback.print_exc()
+    finally:
+        for f in files.values():
+            f.close()
+    print(len(fetched), 'participants')
+
+    if since:
+        for filename in contents:
+            path = os.path.join(outdir, f"{filename}.csv")
+            merge_csv(path, path + suffix, fetched)
+
+    pd.Series(anonymize.mapping, name='wid').to_csv(identifiers_file, index_label='workerid')
+    if latest is not None:
+        with open(watermark_file, 'w') as f:
+            json.dump({'since': latest.isoformat()}, f)
+
+
+TRIALS_SCHEMA = None if pa is None else pa.schema([
+    ('wid', pa.string()),
+    ('trial_index', pa.int32()),
+    ('trialNumber', pa.int32()),
+    ('graph', pa.list_(pa.list_(pa.int16()))),
+    ('rewards', pa.list_(pa.float64())),
+    ('start', pa.int16()),
+    ('n_steps', pa.int16()),
+    ('bonus', pa.float64()),
+])
+
+# One row per logged event; (wid, trial_index) joins to the trials table.
+EVENTS_SCHEMA = None if pa is None else pa.schema([
+    ('wid', pa.string()),
+    ('trial_index', pa.int32()),
+    ('time', pa.int64()),
+    ('event', pa.string()),
+    ('state', pa.int16()),
+    ('info', pa.string()),  # any other logged fields, as json
+])
+
+
+def parquet_tables(trials):
+    """The trials and events tables (see the schemas above) for parsed main trials."""
+    trial_columns = {name: [] for name in TRIALS_SCHEMA.names}
+    event_columns = {name: [] for name in EVENTS_SCHEMA.names}
+    for d in trials:
+        trial = d['trial']
+        for name, value in [
+            ('wid', d['wid']),
+            ('trial_index', d['trial_index']),
+            ('trialNumber', trial.get('trialNumber')),
+            ('graph', trial['graph']),
+            ('rewards', trial['rewards']),
+            ('start', trial['start']),
+            ('n_steps', trial.get('n_steps')),
+            ('bonus', d.get('current_bonus')),
+        ]:
+            trial_columns[name].append(value)
+
+        for event in d['events'] or ():
+            info = {k: v for k, v in event.items() if k not in ('time', 'event', 'state')}
+            event_columns['wid'].append(d['wid'])
+            event_columns['trial_index'].append(d['trial_index'])
+            event_columns['time'].append(event['time'])
+            event_columns['event'].append(event['event'])
+            event_columns['state'].append(event.get('state'))
+            event_columns['info'].append(json.dumps(info) if info else None)
+
+    return pa.table(trial_columns, schema=TRIALS_SCHEMA), pa.table(event_columns, schema=EVENTS_SCHEMA)
+
+
+def write_parquet(version, tables):
+    """
+    Writes the (trials, events) tables from parquet_tables to
+    data/human/{version}/trials.parquet and events.parquet, so that analyses can
+    select columns instead of parsing trials.json.
+    """
+    if pa is None:
+        raise RuntimeError('--parquet requires pyarrow (pip install pyarrow)')
+    trials, events = zip(*(tables or [parquet_tables([])]))
+    pq.write_table(pa.concat_tables(trials), f'data/human/{version}/trials.parquet')
+    pq.write_table(pa.concat_tables(events), f'data/human/{version}/events.parquet')
+
+
+def decode_events(events):
+    """
+    Expands the columnar event log written by CircleGraph's logger (see
+    jspsych-CircleGraphNavigation.js) into the list of {time, event, ...}
+    dicts it encodes, with keys in the order they were logged. Logs that are
+    already a list, or missing, are returned as is.
+    """
+    if not isinstance(events, dict):
+        return events
+    names, info = events['names'], events['info']
+    times = itertools.accumulate(events['dt'])
+    decoded = []
+    for i, (time, code, state) in enumerate(zip(times, events['event'], events['state'])):
+        event = {'time': time, 'event': names[code]}
+        # info holds every other field, state included, in the logged order.
+        event.update(info.get(str(i), ()))
+        if state != -1 and 'state' not in event:
+            event['state'] = state
+        decoded.append(event)
+    return decoded
+
+
+# What reformat needs from the main trials: each one as json (for trials.json),
+# (wid, trial_index, current_bonus) rows, and optionally parquet_tables. These
+# are much cheaper to send back from a worker process than the parsed trials.
+ParsedTrials = namedtuple('ParsedTrials', ['json', 'bonus', 'tables'])
+
+
+def parse_main_trials(rows, parquet=False):
+    """Parses the (wid, data) rows that are main trials, skipping the rest."""
+    trials = []
+    for wid, data in rows:
+        # Cheap test on the raw string, so we don't parse mouse-heavy
+        # instruction and practice trials only to throw them away.
+        if '"main"' not in data:
+            continue
+        trial = json_loads(data)
+        if trial.get('trial_type') == 'main':
+            trial['wid'] = wid
+            # Aborted trials and older data may have no event log.
+            trial['events'] = decode_events(trial.get('events'))
+            trials.append(trial)
+    return ParsedTrials(
+        json=[json.dumps(trial) for trial in trials],
+        bonus=[(trial['wid'], trial['trial_index'], trial.get('current_bonus')) for trial in trials],
+        tables=[parquet_tables(trials)] if parquet else [],
+    )
+
+
+def parse_trials(df, processes=None, parquet=False, chunksize=500, min_pool_bytes=50_000_000):
+    """
+    Parses the main trials in df (wid and data columns) into one ParsedTrials.
+    Inputs under min_pool_bytes are parsed here, since starting the workers
+    costs more than it saves on them.
+    """
+    rows = list(zip(df.wid, df.data))
+    chunks = [rows[i:i+chunksize] for i in range(0, len(rows), chunksize)]
+    parse = partial(parse_main_trials, parquet=parquet)
+    if (processes or os.cpu_count()) == 1 or len(chunks) <= 1 or df.data.str.len().sum() < min_pool_bytes:
+        results = map(parse, chunks)
+    else:
+        with Pool(processes) as pool:
+            results = pool.map(parse, chunks)
+    parsed = ParsedTrials([], [], [])
+    for chunk in results:
+        for combined, part in zip(parsed, chunk):
+            combined.extend(part)
+    return parsed
 
 
-def reformat(version):
+def reformat(version, parquet=False, processes=None):
     os.makedirs(f'data/human/{version}', exist_ok=True)
 
     events = pd.read_csv(f"data/human_raw/{version}/eventdata.csv", header=None)
@@ -110,27 +364,25 @@ def reformat(version):
 
 
     df = pd.read_csv(f"data/human_raw/{version}/trialdata.csv", header=None,
-        names = ["wid", "idx", "timestamp", "data"])
-
-    def parse_row(row):
-        data = json.loads(row.data)
-        data['wid'] = row.wid
-        return data
-
-    data = [parse_row(row) for row in df.itertuples()]
+        names = ["wid", "idx", "timestamp", "data"], usecols=["wid", "data"])
+    main = parse_trials(df, processes, parquet)
 
     with open(f'data/human/{version}/trials.json', 'w') as f:
-        json.dump([d for d in data if d.get('trial_type') == 'main'], f)
+        # the same as json.dump of the list of trials
+        f.write('[' + ', '.join(main.json) + ']')
+    if parquet:
+        write_parquet(version, main.tables)
 
-    df = pd.DataFrame(data).query('trial_type == "main"')
+    df = pd.DataFrame(main.bonus, columns=['wid', 'trial_index', 'current_bonus'])
     bonus = df.loc[df.groupby('wid').trial_index.idxmax()][['wid', 'current_bonus']].set_index('wid')
     identifiers = pd.read_csv(f'data/human_raw/{version}/identifiers.csv').set_index('wid')
     identifiers.join(bonus).dropna().to_csv('bonus.csv', index=False, header=False)
 
 
-def main(version, debug):
-    write_csvs(version, debug)
-    reformat(version)
+def main(version, debug, threads, parquet, incremental, processes):
+    connect_database()
+    write_csvs(version, debug, threads, incremental)
+    reformat(version, parquet, processes)
 
 if __name__ == "__main__":
     parser = ArgumentParser(
@@ -142,8 +394,18 @@ if __name__ == "__main__":
               "parameter in the psiTurk config.txt file that was used when the "
               "data was collected."))
     parser.add_argument("--debug", help="Keep debug participants", action="store_true")
+    parser.add_argument("--parquet", action="store_true",
+                        help="Also write trials.parquet and events.parquet (requires pyarrow)")
+    parser.add_argument("--incremental", action="store_true",
+                        help="Only fetch participants that began or ended since the last export "
+                             "(status changes after that aren't picked up; see write_csvs)")
+    parser.add_argument("--processes", type=int, default=None,
+                        help="Number of processes for parsing trial data (default: one per cpu)")
+    parser.add_argument("--threads", type=int, default=8, help="Number of participants to fetch concurrently")
 
     args = parser.parse_args()
+    if args.parquet and pa is None:
+        parser.error('--parquet requires pyarrow (pip install pyarrow)')
     version = args.version
     if version == None:
         import configparser
@@ -152,4 +414,4 @@ if __name__ == "__main__":
         version = c["Task Parameters"]["experiment_code_version"]
         print("Fetching data for current version: ", version)
 
-    main(version, args.debug)
+    main(version, args.debug, args.threads, args.parquet, args.incremental, args.processes)
@@ -1,7 +1,11 @@
 # import rrtd
 import numpy as np
-import math, random, itertools, functools, collections, collections.abc
+import math, random, itertools, functools, operator, collections, collections.abc
 import os
+import json
+import heapq
+import multiprocessing
+from circle_geometry import circle_geometry
 
 def shuffled(seq, random=random):
     '''
@@ -100,69 +104,257 @@ def normalized_xy_coords(xy, horizontal=True):
     return [(x, y) for x, y in zip(xs, ys)]
 
 
-def generate_circle_orderings(g, *, prohibit_succ_dist=2, rotation_invariant=False):
+def _adjacency(g):
     '''
-    >>> import rrtd
-    >>> assert len(list(generate_circle_orderings(rrtd.Graph({ 0: [1], 1: [0], 2: [3], 3: [2] }), prohibit_succ_dist=1))) == 8
-    >>> assert len(list(generate_circle_orderings(rrtd.Graph({ 0: [1], 1: [0], 2: [3], 3: [2] }), prohibit_succ_dist=1, rotation_invariant=True))) == 2
+    Accepts an rrtd.Graph or a plain mapping from state to successors.
     '''
-    num_states = len(g.state_list)
-    adj = g.adjacency # HACK
-    assert sorted(g.state_list) == list(range(len(g.state_list))), 'Must be a simple state space.'
-    #degree = {k: len(v) for k, v in adj.items()}
-    nodes_degree_desc = sorted(g.state_list, key=lambda s: len(adj[s]), reverse=True)
+    adj = g.adjacency if hasattr(g, 'adjacency') else g # HACK
+    assert sorted(adj) == list(range(len(adj))), 'Must be a simple state space.'
+    return adj
+
+class _CircleSearch:
+    '''
+    Backtracking search over circle orderings, using bitmasks over circle positions.
+
+    States are placed in order of decreasing degree. When a state is placed, we mark the
+    positions near it as banned for the later states that have it as a successor,
+    and backtrack as soon as some unplaced state has no position left.
+
+    With rotation_invariant, the first state is fixed at position 0. With reflection_invariant,
+    the second state must be in the first half of the circle, so we get one ordering per
+    equivalence class of `allrotflip`.
+
+    A `prefix` of positions for the first states restricts the search to one shard of
+    the search space; see `prefixes`.
+    '''
+    def __init__(self, g, *, prohibit_succ_dist=2, rotation_invariant=False, reflection_invariant=False, prefix=()):
+        assert rotation_invariant or not reflection_invariant, 'Reflection invariance is only supported along with rotation invariance.'
+        adj = _adjacency(g)
+        n = self.num_states = len(adj)
+        self.rotation_invariant = rotation_invariant
+        self.reflection_invariant = reflection_invariant
+        self.prefix = tuple(prefix)
+        # HACK we choose by highest degree first??
+        self.nodes = sorted(range(n), key=lambda s: len(adj[s]), reverse=True)
+        # For the state placed at each depth, the later depths whose successors include it.
+        self.later = [
+            [d for d in range(e+1, n) if self.nodes[e] in adj[self.nodes[d]]]
+            for e in range(n)
+        ]
+        # Positions within `prohibit_succ_dist` of each position. We don't need to check for 0.
+        self.near = [
+            functools.reduce(operator.or_, [
+                1 << ((p + sign*dist) % n)
+                for dist in range(1, prohibit_succ_dist+1)
+                for sign in (-1, +1)
+            ], 0) & ~(1 << p)
+            for p in range(n)
+        ]
+        self.full = (1 << n) - 1
+        self.first_half = functools.reduce(operator.or_, [1 << q for q in range(1, n//2+1)], 0)
 
-    def recur(order):
+    def domain(self, depth, free, banned, pos):
+        domain = free & ~banned[depth]
+        if depth == 0 and self.rotation_invariant:
+            # we fix the starting place to be invariant to rotation
+            domain &= 1
+        if depth == 1 and self.reflection_invariant:
+            domain &= self.first_half
+        if depth < len(self.prefix):
+            domain &= 1 << self.prefix[depth]
+        return domain
+
+    def needs_tiebreak(self, pos):
+        # If the second state is opposite the first, the reflection keeps it in place,
+        # so we have to compare full orderings to pick one.
+        return self.reflection_invariant and len(pos) > 1 and 2*pos[1] == self.num_states
+
+    def children(self, depth, free, banned, pos):
         '''
-        order maps circle index to state
+        Yields (free, banned) after placing the state at `depth` in each position
+        of its domain that leaves every later state somewhere to go. Appends the
+        position to `pos` while the caller handles the child.
         '''
-        if len(order) == num_states:
-            ls = [None]*num_states
-            for idx, state in order.items():
-                ls[idx] = state
-            yield tuple(ls)
+        domain = self.domain(depth, free, banned, pos)
+        while domain:
+            bit = domain & -domain
+            domain ^= bit
+            p = bit.bit_length() - 1
+            child_free = free ^ bit
+            child_banned = banned
+            if self.later[depth]:
+                child_banned = list(banned)
+                for d in self.later[depth]:
+                    child_banned[d] |= self.near[p]
+            if all(child_free & ~child_banned[d] for d in range(depth+1, self.num_states)):
+                pos.append(p)
+                yield child_free, child_banned
+                pos.pop()
+
+    def prefixes(self, length, depth=0, free=None, banned=None, pos=None):
+        '''
+        Yields the valid placements of the first `length` states. Together, these
+        partition the orderings, so they can be searched independently.
+        '''
+        if depth == 0:
+            free, banned, pos = self.full, [0]*self.num_states, []
+        if depth == min(length, self.num_states):
+            yield tuple(pos)
             return
-        # HACK we choose by highest degree first??
-        #si = max(range(num_states), key=lambda si: degree[si] if si not in order.values() else float('-inf'))
-        si = nodes_degree_desc[len(order)] # sort of a hack?
-        succ = adj[si]
-        if rotation_invariant and len(order) == 0:
-            # we fix the starting place to be invariant to rotation
-            valid_idxs = [0]
-        else:
-            valid_idxs = [
-                idx
-                for idx in range(num_states)
-                # Needs to be unassigned
-                if idx not in order
-                # And needs successors to be distance `prohibit_succ_dist` at least.
-                if all(
-                    (
-                        order.get((idx-dist) % num_states) not in succ and
-                        order.get((idx+dist) % num_states) not in succ
-                    )
-                    # We don't need to check for 0
-                    for dist in range(1, prohibit_succ_dist+1)
-                )
-            ]
-        for idx in valid_idxs:
-            order[idx] = si
-            yield from recur(order)
-            del order[idx]
-    yield from recur({})
+        for child_free, child_banned in self.children(depth, free, banned, pos):
+            yield from self.prefixes(length, depth+1, child_free, child_banned, pos)
+
+    def ordering(self, pos):
+        ls = [None]*self.num_states
+        for depth, p in enumerate(pos):
+            ls[p] = self.nodes[depth]
+        ls = tuple(ls)
+        if self.needs_tiebreak(pos):
+            mirror = tuple(ls[-p % self.num_states] for p in range(self.num_states))
+            if mirror < ls:
+                return None
+        return ls
+
+    def orderings(self, depth=0, free=None, banned=None, pos=None):
+        if depth == 0:
+            free, banned, pos = self.full, [0]*self.num_states, []
+        if depth == self.num_states:
+            ls = self.ordering(pos)
+            if ls is not None:
+                yield ls
+            return
+        for child_free, child_banned in self.children(depth, free, banned, pos):
+            yield from self.orderings(depth+1, child_free, child_banned, pos)
+
+    def count(self, depth=0, free=None, banned=None, pos=None):
+        if depth == 0:
+            free, banned, pos = self.full, [0]*self.num_states, []
+        if depth == self.num_states:
+            return int(self.ordering(pos) is not None)
+        if depth == self.num_states - 1 and not self.needs_tiebreak(pos):
+            # Every remaining position is a valid ordering, so we can just count them.
+            return bin(self.domain(depth, free, banned, pos)).count('1')
+        return sum(
+            self.count(depth+1, child_free, child_banned, pos)
+            for child_free, child_banned in self.children(depth, free, banned, pos)
+        )
+
+def generate_circle_orderings(g, *, prohibit_succ_dist=2, rotation_invariant=False, reflection_invariant=False):
+    '''
+    Yields orderings (tuples mapping circle index to state) where no state is within
+    `prohibit_succ_dist` of one of its successors.
+
+    >>> import rrtd
+    >>> assert len(list(generate_circle_orderings(rrtd.Graph({ 0: [1], 1: [0], 2: [3], 3: [2] }), prohibit_succ_dist=1))) == 8
+    >>> assert len(list(generate_circle_orderings(rrtd.Graph({ 0: [1], 1: [0], 2: [3], 3: [2] }), prohibit_succ_dist=1, rotation_invariant=True))) == 2
+    >>> list(generate_circle_orderings({ 0: [1], 1: [0], 2: [3], 3: [2] }, prohibit_succ_dist=1, rotation_invariant=True, reflection_invariant=True))
+    [(0, 2, 1, 3)]
+    '''
+    search = _CircleSearch(
+        g, prohibit_succ_dist=prohibit_succ_dist,
+        rotation_invariant=rotation_invariant, reflection_invariant=reflection_invariant)
+    yield from search.orderings()
+
+def count_circle_orderings(g, *, prohibit_succ_dist=2, rotation_invariant=False, reflection_invariant=False):
+    '''
+    Counts the orderings `generate_circle_orderings` would yield, without building them.
+
+    >>> count_circle_orderings({ 0: [1], 1: [0], 2: [3], 3: [2] }, prohibit_succ_dist=1)
+    8
+    >>> count_circle_orderings({ 0: [1], 1: [0], 2: [3], 3: [2] }, prohibit_succ_dist=1, rotation_invariant=True, reflection_invariant=True)
+    1
+    '''
+    search = _CircleSearch(
+        g, prohibit_succ_dist=prohibit_succ_dist,
+        rotation_invariant=rotation_invariant, reflection_invariant=reflection_invariant)
+    return search.count()
+
+def correlate_circle_orders(distance_matrix, orders):
+    '''
+    Vectorized `correlate_distance_and_coordinates` for a (batch, num_states) array
+    of circle orders. Returns an array with the correlation for each order.
+
+    >>> d = np.abs(np.subtract.outer(range(5), range(5)))
+    >>> orders = [(0, 1, 2, 3, 4), (1, 0, 2, 4, 3)]
+    >>> assert np.allclose(correlate_circle_orders(d, orders), [correlate_distance_and_coordinates(d, circle_order=list(o)) for o in orders])
+    '''
+    orders = np.asarray(orders)
+    batch, n = orders.shape
+    # Invert each order, to get the circle position of each state.
+    pos = np.empty_like(orders)
+    np.put_along_axis(pos, orders, np.broadcast_to(np.arange(n), orders.shape), axis=1)
+
+    chord = circle_geometry(n).distances
+
+    # This can pretty dramatically change things
+    task_dist = (distance_matrix != 0) & (distance_matrix != 1)
+    i, j = np.nonzero(task_dist)
+    x = distance_matrix[i, j] - distance_matrix[i, j].mean()
+    y = chord[pos[:, i], pos[:, j]]
+    y = y - y.mean(axis=1, keepdims=True)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return (y @ x) / (np.linalg.norm(y, axis=1) * np.linalg.norm(x))
+
+def _best_circle_layouts_in_shard(args):
+    adj, distance_matrix, prohibit_succ_dist, prefix, k, batch_size = args
+    search = _CircleSearch(
+        adj, prohibit_succ_dist=prohibit_succ_dist,
+        rotation_invariant=True, reflection_invariant=True, prefix=prefix)
+    top = []
+    orderings = search.orderings()
+    while True:
+        batch = list(itertools.islice(orderings, batch_size))
+        if not batch:
+            return top
+        corrs = np.nan_to_num(correlate_circle_orders(distance_matrix, batch), nan=-np.inf)
+        # Only orders that can make it into the top k need to go through the heap.
+        for idx in np.argsort(-corrs)[:k]:
+            item = (float(corrs[idx]), batch[idx])
+            if len(top) < k:
+                heapq.heappush(top, item)
+            elif item > top[0]:
+                heapq.heapreplace(top, item)
+
+def best_circle_layouts(g, distance_matrix, *, k=10, prohibit_succ_dist=2, shard_length=2, batch_size=4096, processes=None):
+    '''
+    Finds the k circle orderings whose Euclidean distances best correlate with `distance_matrix`
+    (e.g. from rrtd.floyd_warshall). Since the correlation doesn't change under rotations
+    and flips of the circle, we only score one ordering per `allrotflip` class.
+
+    The search space is split into shards by the positions of the first `shard_length` states,
+    which are scored in batches across a process pool.
+
+    Returns a list of (correlation, ordering), best first.
+
+    >>> line = {0: [1], 1: [0, 2], 2: [1, 3], 3: [2, 4], 4: [3]}
+    >>> d = np.abs(np.subtract.outer(range(5), range(5)))
+    >>> [(round(corr, 3), order) for corr, order in best_circle_layouts(line, d, k=2, prohibit_succ_dist=0, processes=1)]
+    [(0.894, (1, 0, 2, 4, 3)), (0.8, (1, 4, 2, 0, 3))]
+    '''
+    adj = {s: list(succ) for s, succ in _adjacency(g).items()}
+    search = _CircleSearch(adj, prohibit_succ_dist=prohibit_succ_dist, rotation_invariant=True, reflection_invariant=True)
+    shards = [
+        (adj, distance_matrix, prohibit_succ_dist, prefix, k, batch_size)
+        for prefix in search.prefixes(shard_length)
+    ]
+    if processes == 1:
+        results = map(_best_circle_layouts_in_shard, shards)
+        return heapq.nlargest(k, itertools.chain.from_iterable(results))
+    with multiprocessing.Pool(processes) as pool:
+        results = pool.imap_unordered(_best_circle_layouts_in_shard, shards)
+        return heapq.nlargest(k, itertools.chain.from_iterable(results))
 
 def coordinates_for_circle_order(order):
     '''
     order: array mapping index of position on circle -> state
     '''
     assert sorted(order) == list(range(len(order))), 'State space should be a sequence of numbers'
-    return [
-        (
-            (math.cos(2*math.pi/len(order)*order.index(s)) + 1)/2,
-            (math.sin(2*math.pi/len(order)*order.index(s)) + 1)/2,
-        )
-        for s in range(len(order))
-    ]
+    xy = circle_geometry(len(order)).xy.tolist()
+    # Invert the order once, rather than calling order.index for every state.
+    pos = [None]*len(order)
+    for idx, s in enumerate(order):
+        pos[s] = idx
+    return [tuple(xy[pos[s]]) for s in range(len(order))]
 
 def _validate_and_count_experiment(experiment, assignment_spec):
     '''
@@ -232,6 +424,71 @@ def _validate_and_count_experiment(experiment, assignment_spec):
     return counts
 
 
+class CounterbalanceScheduler:
+    '''
+    Assigns combinations of counterbalanced factors, given the number of levels of each factor.
+    Like `block_rand`, we go through shuffled blocks of the full cross product, so
+    each assignment costs O(1) and counts are always balanced to within one.
+
+    Assignment can be continued later (e.g. for the next 500 participants) by saving
+    `state()` and passing it back in.
+
+    >>> s = CounterbalanceScheduler([2, 3], random=random.Random(42))
+    >>> sorted(s.next(6))
+    [(0, 0), (0, 1), (0, 2), (1, 0), (1, 1), (1, 2)]
+    >>> _ = s.next(2)
+    >>> s2 = CounterbalanceScheduler([2, 3], random=random.Random(0), state=json.loads(json.dumps(s.state())))
+    >>> sorted(collections.Counter(s2.next(4)).values()), sorted(s2.counts().values())
+    ([1, 1, 1, 1], [2, 2, 2, 2, 2, 2])
+    '''
+    def __init__(self, sizes, *, random=random, state=None):
+        self.sizes = list(sizes)
+        self.size = functools.reduce(lambda a, b: a*b, self.sizes, 1)
+        self.random = random
+        # Total number of assignments so far, and what remains of the current block.
+        self.assigned = 0
+        self.block = []
+        if state is not None:
+            assert state['sizes'] == self.sizes, 'Saved state is for different factors.'
+            self.assigned = state['assigned']
+            self.block = list(state['block'])
+
+    def state(self):
+        return dict(sizes=self.sizes, assigned=self.assigned, block=list(self.block))
+
+    def decode(self, idx):
+        '''
+        Maps an index into the cross product to a tuple of levels, in the order of `itertools.product`.
+        '''
+        levels = []
+        for size in reversed(self.sizes):
+            idx, level = divmod(idx, size)
+            levels.append(level)
+        return tuple(reversed(levels))
+
+    def next(self, count):
+        rv = []
+        while len(rv) < count:
+            if not self.block:
+                self.block = shuffled(range(self.size), random=self.random)
+            take = min(count - len(rv), len(self.block))
+            rv.extend(self.block[-take:])
+            del self.block[-take:]
+        self.assigned += count
+        return [self.decode(idx) for idx in rv]
+
+    def counts(self):
+        '''
+        The number of assignments of each combination so far.
+        '''
+        in_block = len(self.block) and self.size - len(self.block)
+        full_blocks = (self.assigned - in_block) // self.size
+        remaining = set(self.block)
+        return {
+            self.decode(idx): full_blocks + (1 if self.block and idx not in remaining else 0)
+            for idx in range(self.size)
+        }
+
 def sample_factor_assignment(factored_config, *, counterbalance=[], sample=[], count, random=random):
     '''
     >>> list(sorted(sample_factor_assignment(dict(f=range(10)), counterbalance=['f'], count=10, random=random.Random(42))['f'])) # all items enumerated
@@ -240,7 +497,7 @@ def sample_factor_assignment(factored_config, *, counterbalance=[], sample=[], c
     >>> list(sorted(zip(a['f'], a['g'])))
     [(0, 0), (0, 1), (1, 0), (1, 1)]
     >>> list(sorted(sample_factor_assignment(dict(f=range(10)), sample=['f'], count=10, random=random.Random(42))['f'])) # just random
-    [0, 0, 1, 2, 3, 3, 8, 8, 8, 9]
+    [0, 1, 1, 1, 2, 3, 3, 4, 8, 9]
     '''
     assert not (set(counterbalance) & set(sample)), 'should have disjoint set of things for counterbalancing & sampling'
     counts = _validate_and_count_experiment(factored_config, counterbalance+sample)
@@ -248,38 +505,20 @@ def sample_factor_assignment(factored_config, *, counterbalance=[], sample=[], c
     # We do column-based storage to avoid repeating keys
     res = {k: [] for k in counterbalance+sample}
 
-    # We count every combination of the values for the counterbalanced keys
-    cb_ct = {key: 0 for key in itertools.product(*[range(counts[cb]) for cb in counterbalance])}
-    # This should equal the product of the counts of the keys, by the definition of itertools.product()
-    assert len(cb_ct) == functools.reduce(lambda a, b: a*b, [counts[cb] for cb in counterbalance], 1)
-
-    # We generate all of our samples.
-    for _ in range(count):
-        # First, we counterbalance.
-
-        # 1. Find minimum value based on current counts
-        minval = min(cb_ct.values())
-        # 2. Sample from items with minimum value
-        sampled = random.choice([key for key, ct in cb_ct.items() if ct == minval])
-        # 3. Add to our count to factor into future counterbalancing
-        cb_ct[sampled] += 1
-
-        # 4. Assign values into column-wise storage.
+    # First, we counterbalance, by going through blocks of the cross product of the counterbalanced keys.
+    scheduler = CounterbalanceScheduler([counts[cb] for cb in counterbalance], random=random)
+    for sampled in scheduler.next(count):
+        # Assign values into column-wise storage.
         for key, sampled_idx in zip(counterbalance, sampled):
             assert 0 <= sampled_idx < counts[key], 'This should only happen if the application is incorrectly matching indices and keys'
             res[key].append(sampled_idx)
 
-        # For other keys, we just sample!
-        for key in sample:
-            res[key].append(random.choice(range(counts[key])))
-
-    # Now, some simple checks.
-    empirical_ct = collections.Counter([tuple([res[key][idx] for key in counterbalance]) for idx in range(count)])
-    # When we count again, ensure the values match. This is a sanity check for the application logic.
-    for key, ct in cb_ct.items():
-        assert empirical_ct[key] == ct
+    # For other keys, we just sample!
+    for key in sample:
+        res[key] = [random.choice(range(counts[key])) for _ in range(count)]
 
     # We ensure the counterbalancing has worked.
+    cb_ct = scheduler.counts()
     minval = min(cb_ct.values())
     maxval = max(cb_ct.values())
     assert maxval - minval in (0, 1), 'Counterbalancing max and min values should be equal or off by one.'
@@ -324,35 +563,59 @@ def correlate_distance_and_coordinates(distance_matrix, *, circle_order=None, co
     >>> assert np.isclose(correlate_distance_and_coordinates(line_dist, coordinates=line_coord), 1)
     '''
     if coordinates is None:
-        coordinates = coordinates_for_circle_order(circle_order)
+        # For circle orders, the distances are just a lookup into the cached geometry.
+        assert sorted(circle_order) == list(range(distance_matrix.shape[0])), 'State space should be a sequence of numbers'
+        pos = np.argsort(circle_order)
+        c_d = circle_geometry(len(circle_order)).distances[pos[:, None], pos[None, :]]
     else:
         assert circle_order is None
-
-    coordinates = np.array(coordinates)
-    assert coordinates.shape == (distance_matrix.shape[0], 2)
-    c_d = np.linalg.norm(coordinates[:, None, :] - coordinates[None, :, :], axis=-1)
+        coordinates = np.array(coordinates)
+        assert coordinates.shape == (distance_matrix.shape[0], 2)
+        c_d = np.linalg.norm(coordinates[:, None, :] - coordinates[None, :, :], axis=-1)
     # This can pretty dramatically change things
     task_dist = (distance_matrix != 0) & (distance_matrix != 1)
     return np.corrcoef(distance_matrix[task_dist].flatten(), c_d[task_dist].flatten())[0, 1]
 
+def null_correlations(distance_matrix, *, samples=2000, random=random):
+    '''
+    Correlations for `samples` uniformly random circle orders, computed in one batch.
+    '''
+    n = distance_matrix.shape[0]
+    rng = np.random.default_rng(random.getrandbits(64))
+    orders = rng.permuted(np.tile(np.arange(n), (samples, 1)), axis=1)
+    return correlate_circle_orders(distance_matrix, orders)
+
+def coordinates_relative_to_null(distance_matrix, circle_orders, *, samples=2000, random=random, corrs=None):
+    '''
+    For each circle order, returns the fraction of random circle orders with a higher
+    correlation between geodesic and Euclidean distances, along with the null correlations.
+    Pass `corrs` if the correlations of circle_orders are already computed.
+
+    >>> d = np.abs(np.subtract.outer(range(6), range(6)))
+    >>> qs, null = coordinates_relative_to_null(d, [[1, 0, 2, 4, 5, 3], [0, 1, 2, 3, 4, 5]], samples=500, random=random.Random(0))
+    >>> qs.tolist(), null.shape
+    ([0.0, 0.974], (500,))
+    '''
+    null = null_correlations(distance_matrix, samples=samples, random=random)
+    if corrs is None:
+        corrs = correlate_circle_orders(distance_matrix, circle_orders)
+    # Number of null correlations above each of ours.
+    above = samples - np.searchsorted(np.sort(null), corrs, side='right')
+    return above / samples, null
+
 def plot_coordinates_relative_to_null(
     mdp, *,
     circle_order=None, circle_orders=None, samples=2000, return_quantiles=False,
 ):
     import matplotlib.pyplot as plt
-    from tqdm.auto import tqdm
 
     if circle_order is not None:
         assert circle_orders is None
         circle_orders = [circle_order]
 
     d = rrtd.floyd_warshall(mdp)
-    corrs = [correlate_distance_and_coordinates(d, circle_order=co) for co in circle_orders]
-
-    null = [
-        correlate_distance_and_coordinates(d, circle_order=shuffled(mdp.state_list))
-        for _ in tqdm(range(samples), leave=False)
-    ]
+    corrs = correlate_circle_orders(d, circle_orders)
+    qs, null = coordinates_relative_to_null(d, circle_orders, samples=samples, corrs=corrs)
 
     f, ax = plt.subplots(figsize=(4, 3))
     plt.hist(null, bins=30, alpha=0.3)
@@ -361,7 +624,7 @@ def plot_coordinates_relative_to_null(
     ax.set(title='Histogram of correlation of geodesic and euclidean embeddings\nSampled embeddings are lines')
 
     if return_quantiles:
-        qs = [np.sum(c<null)/samples for c in corrs]
+        qs = list(qs)
         if circle_order is None:
             return qs
         else:
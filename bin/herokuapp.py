@@ -43,6 +43,9 @@ class ExperimentServer(exp.ExperimentServer):
         # due to forked workers sharing connections. https://stackoverflow.com/q/22752521
         app = super().load()
         assert app.url_map.bind('').match('/complete') == ('custom_code.debug_complete_prolific', {}), 'Custom Prolific handler is not correctly configured.'
+        assert app.url_map.bind('').match('/sync/x', method='PUT') == ('custom_code.sync_and_record_bonus', {'uid': 'x'}), 'Custom sync handler is not correctly configured.'
+        assert app.url_map.bind('').match('/sync/x', method='GET') == ('custom_code.load_reconciled', {'uid': 'x'}), 'Custom sync handler is not correctly configured.'
+        assert app.url_map.bind('').match('/static/json/config/1.json') == ('custom_code.config_file', {'name': '1.json'}), 'Precompressed config handler is not correctly configured.'
 
         if os.getenv('FLASK_ENV') == 'development':
             app.config.update(SEND_FILE_MAX_AGE_DEFAULT=0)
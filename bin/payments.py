@@ -0,0 +1,69 @@
+'''
+Payment reconciliation shared by `prolific.py approve_and_bonus` and
+approve_and_bonus.py: works out which submissions to approve and how much
+bonus is still due, given the bonuses in bonus.csv (written by
+fetch_data.reformat) and the study's submissions. Prolific in prolific.py
+carries out the result.
+'''
+import collections
+import csv
+
+Reconciliation = collections.namedtuple('Reconciliation', ['to_approve', 'bad_code', 'bonus_due', 'missing', 'paid'])
+
+
+def read_bonuses(path='bonus.csv'):
+    '''
+    The bonus (in dollars) owed to each Prolific participant id. The file has
+    no header; rows are participant_id,bonus.
+    '''
+    with open(path, newline='') as f:
+        return {pid: float(bonus) for pid, bonus in csv.reader(f)}
+
+
+def completion_codes(study):
+    '''The codes that mark a submission of `study` (from /studies/<id>/) as completed.'''
+    return {x['code'] for x in study['completion_codes'] if x['code_type'] == 'COMPLETED'}
+
+
+def reconcile(submissions, bonuses, codes, approved=(), ledger_paid=None, ignore_code=False):
+    '''
+    Joins bonuses (participant id -> dollars) against submissions.
+
+    We approve submissions awaiting review that gave one of the completion
+    codes (or any code, with ignore_code) and that we haven't approved
+    already. Each participant has been paid the larger of the bonus Prolific
+    shows and the total in our ledger, and is due the rest of their bonus.
+    Bonuses for participants without a submission are `missing`.
+
+    >>> subs = [
+    ...     {'participant_id': 'a', 'status': 'AWAITING REVIEW', 'study_code': 'OK', 'bonus_payments': []},
+    ...     {'participant_id': 'b', 'status': 'AWAITING REVIEW', 'study_code': 'NO', 'bonus_payments': []},
+    ...     {'participant_id': 'c', 'status': 'APPROVED', 'study_code': 'OK', 'bonus_payments': [50]},
+    ... ]
+    >>> r = reconcile(subs, {'a': 1.0, 'c': 1.0, 'd': 2.0}, {'OK'}, ledger_paid={'a': 0.25})
+    >>> r.to_approve, r.bad_code, r.bonus_due, r.missing
+    (['a'], ['b'], [('a', 0.75), ('c', 0.5)], ['d'])
+    '''
+    ledger_paid = ledger_paid or {}
+    by_id = {sub['participant_id']: sub for sub in submissions}
+
+    to_approve, bad_code = [], []
+    approved = set(approved)
+    for pid, sub in by_id.items():
+        if sub['status'] != 'AWAITING REVIEW' or pid in approved:
+            continue
+        if ignore_code or sub['study_code'] in codes:
+            to_approve.append(pid)
+        else:
+            bad_code.append(pid)
+
+    paid = {pid: max(sum(sub['bonus_payments']) / 100, ledger_paid.get(pid, 0))
+            for pid, sub in by_id.items()}
+    bonus_due = []
+    for pid, bonus in bonuses.items():
+        if pid in paid:
+            due = round(bonus - paid[pid], 2)
+            if due > 0:
+                bonus_due.append((pid, due))
+    missing = [pid for pid in bonuses if pid not in by_id]
+    return Reconciliation(to_approve, bad_code, bonus_due, missing, paid)
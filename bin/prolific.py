@@ -3,17 +3,153 @@ import sys
 import subprocess
 import os
 import re
+import json
+import time
+import hashlib
+import threading
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from configparser import ConfigParser
 from markdown import markdown
 import random
 from fire import Fire
-from functools import cache, cached_property
+from functools import cached_property
+
+
+class ProlificError(Exception):
+    """An API request that failed (after retrying, where that is safe)."""
+    def __init__(self, method, url, status_code, response):
+        super().__init__(f'Problem with API request: {method} {url} ({status_code})\n{response}')
+        self.status_code = status_code
+        self.response = response
+
+
+class ResponseCache(object):
+    """GET responses saved on disk, one json file per url, with their ETags."""
+    def __init__(self, directory):
+        self.directory = directory
+
+    def _path(self, url):
+        return os.path.join(self.directory, hashlib.sha1(url.encode()).hexdigest() + '.json')
+
+    def get(self, url):
+        try:
+            with open(self._path(url)) as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def put(self, url, response, etag=None):
+        os.makedirs(self.directory, exist_ok=True)
+        path = self._path(url)
+        tmp = f'{path}.{os.getpid()}.{threading.get_ident()}'  # pages are fetched concurrently
+        with open(tmp, 'w') as f:
+            json.dump({'url': url, 'time': time.time(), 'etag': etag, 'response': response}, f)
+        os.replace(tmp, path)
+
+    def invalidate(self, prefixes):
+        """Drops the responses for urls starting with any of prefixes."""
+        try:
+            names = os.listdir(self.directory)
+        except FileNotFoundError:
+            return
+        for name in names:
+            if not name.endswith('.json'):
+                continue  # a put in progress
+            path = os.path.join(self.directory, name)
+            try:
+                with open(path) as f:
+                    url = json.load(f)['url']
+                if url.startswith(tuple(prefixes)):
+                    os.remove(path)
+            except (FileNotFoundError, ValueError):
+                pass
+
+
+class Ledger(object):
+    """
+    Local record of the approvals and bonus payments we made, one json line
+    per entry, so that a rerun after a crash or partial failure never
+    re-approves or pays twice.
+
+    A bonus batch is recorded as sent before we ask Prolific to pay it, and as
+    paid once it confirms, or failed if it refuses with a 4xx. Batches that
+    were sent but never confirmed count as paid.
+    """
+    def __init__(self, path='.prolific_ledger.jsonl'):
+        self.path = path
+        self.lock = threading.Lock()
+
+    def record(self, **entry):
+        entry['time'] = time.time()
+        with self.lock, open(self.path, 'a') as f:
+            f.write(json.dumps(entry) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+
+    def entries(self, study_id):
+        if not os.path.isfile(self.path):
+            return []
+        with open(self.path) as f:
+            entries = [json.loads(line) for line in f if line.strip()]
+        return [e for e in entries if e['study_id'] == study_id]
+
+    def approved(self, study_id):
+        return {p for e in self.entries(study_id) if e['action'] == 'approve' for p in e['participant_ids']}
+
+    def bonuses(self, study_id):
+        """
+        The total bonus each participant has been paid (at least), and the ids
+        of unconfirmed batches. Batches record totals rather than amounts, so
+        this is right whether or not Prolific already shows the payments.
+        """
+        entries = self.entries(study_id)
+        done = {e['batch']: e['action'] for e in entries if e['action'] in ('bonus_paid', 'bonus_failed')}
+        paid = {}
+        unconfirmed = []
+        for e in entries:
+            if e['action'] != 'bonus_sent' or done.get(e['batch']) == 'bonus_failed':
+                continue
+            if e['batch'] not in done:
+                unconfirmed.append(e['batch'])
+            for p, total in e['totals'].items():
+                paid[p] = max(paid.get(p, 0), total)
+        return paid, unconfirmed
+
+
+def study_urls(study_id):
+    """The cached urls a change to study_id can affect: its own and the project listings."""
+    return [f'/studies/{study_id}/', '/projects/']
+
+
+def chunked(items, size):
+    items = list(items)
+    return [items[i:i+size] for i in range(0, len(items), size)]
 
 
 class Prolific(object):
-    """Prolific API wrapper"""
-    def __init__(self, token=None):
+    """Prolific API wrapper
+
+    All requests share one keep-alive session. Idempotent requests (GET, PUT,
+    DELETE) are retried with exponential backoff on 429 and 5xx responses;
+    POSTs are not, so that we never approve or pay twice. base_url (or the
+    PROLIFIC_API_URL environment variable) can point to a local stand-in for
+    testing.
+
+    GET responses are cached in cache_dir for cache_ttl seconds, and
+    revalidated with If-None-Match after that when the API gave an ETag. Other
+    requests drop the cached responses they may have changed (unless Prolific
+    refused them): those for urls under the paths in `invalidate`, or all of
+    them if it isn't given. Pass
+    ttl=0 to a GET to always revalidate, and cache_dir=None to disable
+    caching.
+    """
+    RETRY_METHODS = frozenset(['HEAD', 'GET', 'PUT', 'DELETE', 'OPTIONS'])
+
+    def __init__(self, token=None, base_url=None, max_workers=8, retries=5, backoff=0.5,
+                 cache_dir='.prolific_cache', cache_ttl=300, ledger='.prolific_ledger.jsonl'):
         super(Prolific, self).__init__()
         if token is None:
             token = os.getenv('PROLIFIC_TOKEN')
@@ -21,34 +157,126 @@ class Prolific(object):
                 raise ValueError('You must provide a token or set the PROLIFIC_TOKEN environment variable.')
 
         self.token = token
-
-    def request(self, method, url, **kws):
-        if url.startswith('/'):
-            url = 'https://api.prolific.co/api/v1' + url
-        if not url.endswith('/') and '?' not in url:  # adding / prevents redirecting POST requests
-            url += '/'
-        r = requests.request(method, url, **kws, headers={
-            'Authorization': f'Token {self.token}',
-        })
-        response = r.json()
+        self.base_url = base_url or os.getenv('PROLIFIC_API_URL', 'https://api.prolific.co/api/v1')
+        self.max_workers = max_workers
+        self.session = requests.Session()
+        self.session.headers['Authorization'] = f'Token {token}'
+        # urllib3 renamed method_whitelist to allowed_methods in 1.26
+        methods = 'allowed_methods' if hasattr(Retry, 'DEFAULT_ALLOWED_METHODS') else 'method_whitelist'
+        retry = Retry(total=retries, backoff_factor=backoff, status_forcelist=[429, 500, 502, 503, 504],
+                      raise_on_status=False, **{methods: self.RETRY_METHODS})
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max_workers, max_retries=retry)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.ledger = Ledger(ledger)
+        self.cache_ttl = cache_ttl
+        self.cache = None
+        if cache_dir is not None:
+            # separate directories so that different accounts never share responses
+            self.cache = ResponseCache(os.path.join(cache_dir, hashlib.sha1(token.encode()).hexdigest()[:12]))
+
+    def _send(self, method, url, **kws):
+        r = self.session.request(method, url, **kws)
+        if r.status_code == 304:
+            return r, None
+        response = r.json() if r.content else None
         if r.ok:
-            return response
+            return r, response
         else:
-            print(f'Problem with API request: {url}')
-            print(response)
-            exit(1)
-
-    def get(self, url, **kws):
-        return self.request('GET', url, **kws)
+            raise ProlificError(method, url, r.status_code, response)
 
-    def post(self, url, json=None, **kws):
-        return self.request('POST', url, json=json, **kws)
-
-    def patch(self, url, json=None, **kws):
-        return self.request('PATCH', url, json=json, **kws)
+    def _url(self, url):
+        if url.startswith('/'):
+            url = self.base_url + url
+        return url
 
-    def delete(self, url, json=None, **kws):
-        return self.request('DELETE', url, json=json, **kws)
+    def request(self, method, url, ttl=None, invalidate=None, **kws):
+        url = self._url(url)
+        if not url.endswith('/') and '?' not in url:  # adding / prevents redirecting POST requests
+            url += '/'
+        if self.cache is None:
+            return self._send(method, url, **kws)[1]
+        if method != 'GET':
+            prefixes = [self.base_url] if invalidate is None else [self._url(p) for p in invalidate]
+            try:
+                return self._send(method, url, **kws)[1]
+            except ProlificError as e:
+                if 400 <= e.status_code < 500:
+                    prefixes = []  # refused, so nothing changed
+                raise
+            finally:
+                if prefixes:
+                    self.cache.invalidate(prefixes)
+
+        entry = self.cache.get(url)
+        if entry and time.time() - entry['time'] < (self.cache_ttl if ttl is None else ttl):
+            return entry['response']
+        headers = {'If-None-Match': entry['etag']} if entry and entry['etag'] else None
+        r, response = self._send(method, url, headers=headers, **kws)
+        if r.status_code == 304:
+            response = entry['response']
+        self.cache.put(url, response, r.headers.get('ETag'))
+        return response
+
+    def get(self, url, ttl=None, **kws):
+        return self.request('GET', url, ttl=ttl, **kws)
+
+    def post(self, url, json=None, invalidate=None, **kws):
+        return self.request('POST', url, json=json, invalidate=invalidate, **kws)
+
+    def patch(self, url, json=None, invalidate=None, **kws):
+        return self.request('PATCH', url, json=json, invalidate=invalidate, **kws)
+
+    def delete(self, url, json=None, invalidate=None, **kws):
+        return self.request('DELETE', url, json=json, invalidate=invalidate, **kws)
+
+    def run_batches(self, fn, batches, desc):
+        """
+        Calls fn on each batch concurrently, reporting progress. Returns the
+        (batch, result) pairs that succeeded and the batches that failed.
+        """
+        done, failed = [], []
+        with ThreadPoolExecutor(self.max_workers) as pool:
+            futures = {pool.submit(fn, batch): batch for batch in batches}
+            for i, future in enumerate(as_completed(futures), 1):
+                batch = futures[future]
+                try:
+                    done.append((batch, future.result()))
+                except (ProlificError, requests.RequestException) as e:
+                    print(e)
+                    failed.append(batch)
+                print(f'{desc}: {i}/{len(batches)} batches ({len(failed)} failed)')
+        return done, failed
+
+    def get_all(self, url, page_size=200, ttl=None, attempts=2):
+        """
+        All results of a paginated list endpoint. The first page tells us the
+        total count; the remaining pages are fetched concurrently.
+
+        If the list changes while we page through it, results shift between
+        pages and some are seen twice or not at all. So we drop duplicates
+        (by id) and check that every page agrees on the count and that we got
+        that many results; if not, we fetch everything again, bypassing the
+        cache, and give up with a ProlificError after `attempts` tries.
+        """
+        sep = '&' if '?' in url else '?'
+        for attempt in range(attempts):
+            page = lambda offset: self.get(f'{url}{sep}limit={page_size}&offset={offset}',
+                                           ttl=ttl if attempt == 0 else 0)
+            first = page(0)
+            count = first['meta']['count']
+            # step by what the server actually returned, in case it caps the limit
+            step = len(first['results'])
+            offsets = range(step, count, step) if step else []
+            with ThreadPoolExecutor(self.max_workers) as pool:
+                pages = [first] + list(pool.map(page, offsets))
+            results = {}
+            for res in pages:
+                for r in res['results']:
+                    results.setdefault(r['id'], r)
+            if len(results) == count and all(res['meta']['count'] == count for res in pages):
+                return list(results.values())
+        raise ProlificError('GET', url, None, f'expected {count} results, got {len(results)}')
 
     def post_duplicate(self, study_id, **kws):
         # name, internal_name, description, total_available_places
@@ -62,7 +290,7 @@ class Prolific(object):
                 print('Aborting')
                 exit(1)
 
-        new = self.post(f'/studies/{study_id}/clone/')
+        new = self.post(f'/studies/{study_id}/clone/', invalidate=['/projects/'])
         new_id = new['id']
         if 'name' not in kws:
             kws['name'] = new['name'].replace(' Copy', '')
@@ -74,7 +302,7 @@ class Prolific(object):
                 v = markdown(v)
             kws[k] = v
 
-        new = self.patch(f'/studies/{new_id}/', kws)
+        new = self.patch(f'/studies/{new_id}/', kws, invalidate=study_urls(new_id))
 
         new['cost'] = f"${new['total_cost'] / 100:.2f}"
         for k in ['name', 'internal_name', 'description', 'reward', 'total_available_places', 'cost']:
@@ -88,13 +316,13 @@ class Prolific(object):
         if y.lower() == 'y':
             self.post(f'/studies/{new_id}/transition/', {
                 "action": "PUBLISH"
-            })
+            }, invalidate=study_urls(new_id))
             print('Posted! See submssisions at:')
             print(f'https://app.prolific.co/researcher/workspaces/studies/{new_id}/submissions')
         else:
             y = input('NOT posting. Keep draft? [Y/n] ')
             if y.lower() == 'n':
-                self.delete('/studies/' + new['id'])
+                self.delete('/studies/' + new['id'], invalidate=study_urls(new_id))
             else:
                 print(f'https://app.prolific.co/researcher/workspaces/studies/{new_id}')
 
@@ -111,100 +339,117 @@ class Prolific(object):
             if s['status'] != 'UNPUBLISHED'
         ][-1]['id']
 
-    @cache
-    def submissions(self, study_id):
-        res = self.get(f'/studies/{study_id}/submissions?limit=1000')
-        if len(res['results']) != res['meta']['count']:
-            print("Some submissions were not retrieved. You might have to implemnent paging.")
-            exit(1)
-        return res['results']
-
-    def approve_all(self, study_id, ignore_code=False):
-        to_approve = []
-        bad_code = []
-        completion_codes = [x['code']
-            for x in self.get(f'/studies/{study_id}/')['completion_codes']
-            if x['code_type'] == "COMPLETED"
-        ]
-
-        for sub in self.submissions(study_id):
-            if sub['status'] != 'AWAITING REVIEW':
-                continue
-            if ignore_code or sub['study_code'] in completion_codes:
-                to_approve.append(sub["participant_id"])
-            else:
-                bad_code.append(sub["participant_id"])
-
-        if bad_code:
-            print(f'{len(bad_code)} submissions have an incorrect code. NOT approving. Check',
+    def submissions(self, study_id, ttl=None):
+        return self.get_all(f'/studies/{study_id}/submissions', ttl=ttl)
+
+    def reconcile(self, study_id, bonuses, ignore_code=False):
+        """What to approve and pay for study_id; see payments.reconcile."""
+        import payments
+        codes = payments.completion_codes(self.get(f'/studies/{study_id}/'))
+        ledger_paid, unconfirmed = self.ledger.bonuses(study_id)
+        if unconfirmed:
+            print(f'WARNING: {len(unconfirmed)} bonus batches were sent but never confirmed as paid. '
+                  'Counting them as paid; check them on the Prolific website:', ', '.join(unconfirmed))
+        # ttl=0: never act on a cached status or bonus (e.g. if someone paid on the website)
+        return payments.reconcile(self.submissions(study_id, ttl=0), bonuses, codes,
+                                  approved=self.ledger.approved(study_id), ledger_paid=ledger_paid,
+                                  ignore_code=ignore_code)
+
+    def approve(self, study_id, rec, chunk_size=100):
+        if rec.bad_code:
+            print(f'{len(rec.bad_code)} submissions have an incorrect code. NOT approving. Check',
                 f"https://app.prolific.co/researcher/workspaces/studies/{study_id}/submissions")
 
-        if to_approve:
-            self.post("/submissions/bulk-approve/", {
-                "study_id": study_id,
-                "participant_ids": to_approve
-            })
-            print(f'Approved {len(to_approve)} submissions')
-        else:
+        if not rec.to_approve:
             print('No submissions to approve')
+            return
 
-
-    def assign_bonuses(self, study_id, bonuses):
-        previous_bonus = {sub['participant_id']: sum(sub['bonus_payments']) / 100
-                          for sub in self.submissions(study_id)}
-
-        # n_bonused = sum(previous_bonus > 0)
-        # if n_bonused:
-        #     print(f'{n_bonused} participants already have bonuses, {len(bonuses) - n_bonused} to be bonused')
-        participants = previous_bonus.keys()
-        missing = set(bonuses.keys()) - set(participants)
-        if missing:
-            print('WARNING: some entries of bonuses.csv do not have submissions. Skipping these.')
-            print('\n'.join(f'{p},{bonus:.2f}' for p, bonus in bonuses.items() if p in missing))
+        def approve(participant_ids):
+            self.post("/submissions/bulk-approve/", {
+                "study_id": study_id,
+                "participant_ids": participant_ids
+            }, invalidate=[f'/studies/{study_id}/submissions'])
+            self.ledger.record(study_id=study_id, action='approve', participant_ids=participant_ids)
+
+        done, failed = self.run_batches(approve, chunked(rec.to_approve, chunk_size), 'Approving')
+        print(f'Approved {sum(len(batch) for batch, _ in done)} submissions')
+        if failed:
+            print(f'{sum(map(len, failed))} approvals failed. Run again to retry them.')
+
+    def pay_bonuses(self, study_id, rec, chunk_size=100):
+        if rec.missing:
+            print('WARNING: some entries of bonus.csv do not have submissions. Skipping these.')
+            print('\n'.join(rec.missing))
             print()
 
-        new_bonus = {
-            p: bonuses.get(p, 0) - previous_bonus[p] for p in participants
-        }
-        bonus_string = '\n'.join(f'{p},{bonus:.2f}' for p, bonus in new_bonus.items() if bonus > 0)
-
-        if not bonus_string:
+        if not rec.bonus_due:
             print('No bonuses due')
-        else:
-            resp = self.post('/submissions/bonus-payments/', {
-                'study_id': study_id,
-                'csv_bonuses': bonus_string
-            })
-
-            amt = resp['total_amount'] / 100
-            yes = input(f'Pay ${amt:.2f} in bonuses? [N/y]: ')
-            if yes == 'y':
-                self.post(f'/bulk-bonus-payments/{resp["id"]}/pay/')
-                print('Bonuses paid')
-            else:
-                print('NOT paying bonuses')
+            return
 
-    def check_wage(self, study_id):
-        from dateutil.parser import parse
+        def create(batch):
+            # only sets the payments up; nothing we cache changes until they are paid
+            return self.post('/submissions/bonus-payments/', {
+                'study_id': study_id,
+                'csv_bonuses': '\n'.join(f'{p},{bonus:.2f}' for p, bonus in batch)
+            }, invalidate=[])
+
+        created, failed = self.run_batches(create, chunked(rec.bonus_due, chunk_size), 'Setting up bonuses')
+        if failed:
+            print(f'Could not set up bonuses for {sum(map(len, failed))} participants. Run again to retry them.')
+        if not created:
+            return
+
+        amt = sum(resp['total_amount'] for _, resp in created) / 100
+        yes = input(f'Pay ${amt:.2f} in bonuses? [N/y]: ')
+        if yes != 'y':
+            print('NOT paying bonuses')
+            return
+
+        def pay(job):
+            batch, resp = job
+            self.ledger.record(study_id=study_id, action='bonus_sent', batch=resp['id'],
+                               totals={p: round(rec.paid[p] + bonus, 2) for p, bonus in batch})
+            try:
+                self.post(f'/bulk-bonus-payments/{resp["id"]}/pay/',
+                          invalidate=[f'/studies/{study_id}/submissions'])
+            except ProlificError as e:
+                # Only a 4xx means Prolific refused, so nothing was paid. After a
+                # 5xx (e.g. a gateway timeout) or no answer at all we can't tell,
+                # and the batch stays unconfirmed.
+                if 400 <= e.status_code < 500:
+                    self.ledger.record(study_id=study_id, action='bonus_failed', batch=resp['id'])
+                raise
+            self.ledger.record(study_id=study_id, action='bonus_paid', batch=resp['id'])
+
+        paid, failed = self.run_batches(pay, created, 'Paying bonuses')
+        print(f'Bonuses paid to {sum(len(batch) for (batch, _), _ in paid)} participants')
+        if failed:
+            print(f'{sum(len(batch) for batch, _ in failed)} bonuses were not confirmed as paid. Run again to '
+                  'retry the ones Prolific refused; check the others on the Prolific website.')
+
+    def approve_all(self, study_id, ignore_code=False, chunk_size=100):
+        self.approve(study_id, self.reconcile(study_id, {}, ignore_code), chunk_size)
+
+    def assign_bonuses(self, study_id, bonuses, chunk_size=100):
+        self.pay_bonuses(study_id, self.reconcile(study_id, bonuses), chunk_size)
+
+    def approve_and_bonus(self, study_id, bonuses, ignore_code=False, chunk_size=100):
+        """Approves and pays from a single look at the submissions."""
+        rec = self.reconcile(study_id, bonuses, ignore_code)
+        self.approve(study_id, rec, chunk_size)
+        self.pay_bonuses(study_id, rec, chunk_size)
+
+    def check_wage(self, study_id, target_wage=12):
         import numpy as np
+        import wages
 
         basepay = self.get(f'/studies/{study_id}')['reward']
-        target_wage = 12
-
-        times = []
-        pays = []
-        for sub in self.get(f'/studies/{study_id}/submissions')['results']:
-            if not sub['is_complete']:
-                continue
-            seconds = (parse(sub['completed_at']) - parse(sub['started_at'])).total_seconds()
-            hrs = seconds / 3600
-            times.append(hrs)
-            bonus = sum(sub['bonus_payments'])
-            totalpay = (basepay + bonus) / 100
-            pays.append(totalpay)
-
-        pays = np.array(pays)
-        times = np.array(times)
+        df = wages.submission_frame(self.submissions(study_id), basepay)
+        if df.empty:
+            print('no completed submissions yet')
+            return
+        pays = df.pay.to_numpy()
+        times = df.hours.to_numpy()
 
         try:
             import uniplot
@@ -215,16 +460,17 @@ class Prolific(object):
         except ImportError:
             print('pip install uniplot to get a nice plot here')
 
-        inc = np.arange(-5, 5, .05).reshape((-1, 1))
-        W = (pays + inc) / times
-        i = np.argmax(np.median(W, axis=1) > target_wage)
+        print('\nhourly wage by day:')
+        print(wages.wage_percentiles(df).round(2).to_string())
 
-        missing_base = round(inc[i][0], 2)
-        new_base = (basepay / 100) + inc[i][0]
+        inc = wages.base_pay_adjustment(pays, times, target_wage)
+        missing_base = round(inc, 2)
+        new_base = (basepay / 100) + inc
         print(f'base pay is off by ${-missing_base:+.2f}, should be ${new_base:.2f}')
 
     def add_places(self, study_id, new_total):
-        self.patch(f'/studies/{study_id}/', dict(total_available_places=new_total))
+        self.patch(f'/studies/{study_id}/', dict(total_available_places=new_total),
+                   invalidate=study_urls(study_id))
 
 
 def generate_internal_name():
@@ -244,11 +490,8 @@ class CLI(object):
 
         The "last" study refers to the most recently posted study within your project
         """
-        self._prolific.approve_all(self._study_id)
-
-        import pandas as pd
-        bonuses = dict(pd.read_csv('bonus.csv', header=None).set_index(0)[1])
-        self._prolific.assign_bonuses(self._study_id, bonuses)
+        import payments
+        self._prolific.approve_and_bonus(self._study_id, payments.read_bonuses('bonus.csv'))
 
     def post_duplicate(self):
         """Post a duplicate of the last study using current fields in config.txt"""
@@ -335,4 +578,8 @@ class CLI(object):
         return self._prolific.last_study(self._project_id)
 
 if __name__ == '__main__':
-    Fire(CLI)
\ No newline at end of file
+    try:
+        Fire(CLI)
+    except ProlificError as e:
+        print(e)
+        exit(1)
\ No newline at end of file
@@ -0,0 +1,86 @@
+'''
+Wage analytics for Prolific submissions, used by Prolific.check_wage in
+prolific.py. Everything works on the submission list as returned by
+Prolific.submissions (paged and cached), so no extra requests are needed.
+'''
+import numpy as np
+import pandas as pd
+
+
+def submission_frame(submissions, basepay):
+    '''
+    One row per completed submission with its duration in hours, total pay in
+    dollars and hourly wage. basepay is the study reward in cents. Submissions
+    without a positive duration have no wage, so they are left out.
+
+    >>> subs = [
+    ...     {'is_complete': True, 'started_at': '2024-01-01T10:00:00Z',
+    ...      'completed_at': '2024-01-01T10:30:00Z', 'bonus_payments': [100]},
+    ...     {'is_complete': False, 'started_at': '2024-01-01T10:00:00Z',
+    ...      'completed_at': None, 'bonus_payments': []},
+    ...     {'is_complete': True, 'started_at': '2024-01-01T10:00:00Z',
+    ...      'completed_at': '2024-01-01T10:00:00Z', 'bonus_payments': []},
+    ... ]
+    >>> submission_frame(subs, 200)[['hours', 'pay', 'wage']].to_dict('records')
+    [{'hours': 0.5, 'pay': 3.0, 'wage': 6.0}]
+    '''
+    df = pd.DataFrame(submissions, columns=['is_complete', 'started_at', 'completed_at', 'bonus_payments'])
+    df = df[df.is_complete.astype(bool)]
+    started = pd.to_datetime(df.started_at, utc=True)
+    completed = pd.to_datetime(df.completed_at, utc=True)
+    bonus = np.array([sum(b) for b in df.bonus_payments], dtype=float)
+    return pd.DataFrame({
+        'completed_at': completed,
+        'hours': (completed - started).dt.total_seconds().to_numpy() / 3600,
+        'pay': (basepay + bonus) / 100,
+    }).query('hours > 0').assign(wage=lambda d: d.pay / d.hours).reset_index(drop=True)
+
+
+def base_pay_adjustment(pays, hours, target_wage, tol=1e-6):
+    '''
+    The amount to add to everyone's pay so that the median wage is target_wage.
+
+    The median wage is increasing in the adjustment; it is at most the target
+    when everyone earns at most the target (adjustment min(target*hours - pays))
+    and at least the target when everyone does (max(...)), so we bisect
+    between those.
+
+    >>> pays, hours = np.array([3., 3., 4.]), np.array([.5, .25, .25])
+    >>> round(base_pay_adjustment(pays, hours, 12), 6)  # wages are 6, 12 and 16
+    0.0
+    >>> round(base_pay_adjustment(pays, hours, 20), 6)  # wages become 10, 20 and 24
+    2.0
+    '''
+    pays = np.asarray(pays, dtype=float)
+    hours = np.asarray(hours, dtype=float)
+    if not len(pays):
+        raise ValueError('no submissions to compute the median wage of')
+    needed = target_wage * hours - pays
+    lo, hi = needed.min(), needed.max()
+    while hi - lo > tol:
+        mid = (lo + hi) / 2
+        if np.median((pays + mid) / hours) < target_wage:
+            lo = mid
+        else:
+            hi = mid
+    return float(hi)
+
+
+def wage_percentiles(df, freq='D', q=(10, 25, 50, 75, 90)):
+    '''
+    Percentiles of the hourly wage among submissions completed in each period
+    (a pandas frequency, by default days), plus the number of submissions.
+
+    >>> df = pd.DataFrame({'completed_at': pd.to_datetime(['2024-01-01', '2024-01-01', '2024-01-02']),
+    ...                    'wage': [10., 14., 12.]})
+    >>> wage_percentiles(df, q=(50,)).to_dict('index')  # doctest: +NORMALIZE_WHITESPACE
+    {Timestamp('2024-01-01 00:00:00'): {'n': 2, 'p50': 12.0},
+     Timestamp('2024-01-02 00:00:00'): {'n': 1, 'p50': 12.0}}
+    '''
+    period = df.completed_at.dt.floor(freq).rename('period')
+    wages = df.wage.groupby(period)
+    # reindex keeps the columns when there are no submissions yet
+    table = wages.quantile([p / 100 for p in q]).unstack().reindex(columns=[p / 100 for p in q])
+    table.columns = [f'p{p}' for p in q]
+    table.insert(0, 'n', wages.size())
+    return table
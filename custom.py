@@ -1,18 +1,26 @@
 # this file imports custom routes into the experiment server
 
-from flask import Blueprint, render_template, request, jsonify, Response, abort, current_app
+from flask import Blueprint, render_template, request, jsonify, Response, abort, current_app, stream_with_context, url_for, send_from_directory
 from jinja2 import TemplateNotFound
 from functools import wraps
-from sqlalchemy import or_
+from random import choice
+import datetime
+import os
+from sqlalchemy import or_, func, inspect, Column, Integer, String, DateTime, Index
+from sqlalchemy.exc import IntegrityError
 
 from psiturk.psiturk_config import PsiturkConfig
-from psiturk.experiment_errors import ExperimentError, InvalidUsage
+from psiturk.experiment_errors import ExperimentError, ExperimentApiError, InvalidUsage
 from psiturk.user_utils import PsiTurkAuthorization, nocache
 
 # # Database setup
 from psiturk.db import db_session, init_db
-from psiturk.models import Participant
+from psiturk.models import Participant, Base
+from psiturk.psiturk_statuses import NOT_ACCEPTED, ALLOCATED, STARTED, COMPLETED, SUBMITTED, CREDITED, QUITEARLY, BONUSED
 from json import dumps, loads
+from participant_queries import PARTICIPANT_COLUMNS, query_participants, iter_participants, TrialRecord, appended_count, reconcile
+import csv
+import io
 
 # load the configuration options
 config = PsiturkConfig()
@@ -41,12 +49,16 @@ def debug_complete_prolific():
 
     # Importing here to avoid a circular import when gunicorn runs the server.
     from psiturk.experiment import debug_complete
+    user = Participant.query.filter(Participant.uniqueid == request.args['uniqueId']).one()
+    was_finished = user.status in FINISHED
+    fold_trial_records(user)
     # First we run this to make sure data is appropriately saved.
     original_response = debug_complete()
+    if not was_finished:
+        recount_late_finisher(user)
 
     # Then, we see whether we should use that response.
     mode = request.args['mode']
-    user = Participant.query.filter(Participant.uniqueid == request.args['uniqueId']).one()
     # Our convention for prolific studies are that the hitid is the string `prolific`.
     # Only when we're serving a sandbox/live (aka non-debug) request do we route people to
     # a completion code.
@@ -78,21 +90,286 @@ def debug_complete2():
         user_json[dt] = getattr(user, dt)
         if user_json[dt]:
             user_json[dt] = user_json[dt].isoformat()
-    user_json['datastring'] = loads(user.datastring)
+    user_json['datastring'] = reconcile(unique_id, loads(user.datastring))
     user_json = dumps(user_json, sort_keys=True, indent=4)
     return render_template('complete.html', user_json=user_json)
 
 
-def get_participants(codeversion):
-    return (
-        Participant
-        .query
-        .filter(Participant.codeversion == codeversion)
-        # .filter(Participant.status >= 3)  # only take completed
+# Brotli first, since it compresses best.
+PRECOMPRESSED = [('br', '.br'), ('gzip', '.gz')]
+
+
+def _is_fresh_sibling(sibling, path):
+    try:
+        return os.path.getmtime(sibling) >= os.path.getmtime(path)
+    except OSError:
+        return False
+
+
+@custom_code.route('/static/json/config/<name>', methods=['GET'])
+def config_file(name):
+    '''
+    Serves participant configs, using the siblings written by
+    `generate_trial.py --compress` (e.g. 1.json.br) when the browser accepts them
+    and they are at least as new as the config itself. This route shadows the
+    default static route for these files only (checked in herokuapp.py).
+    '''
+    directory = os.path.join(current_app.static_folder, 'json', 'config')
+    path = os.path.join(directory, name)
+    for encoding, suffix in PRECOMPRESSED:
+        if encoding in request.accept_encodings and _is_fresh_sibling(path + suffix, path):
+            response = send_from_directory(directory, name + suffix, mimetype='application/json')
+            response.headers['Content-Encoding'] = encoding
+            break
+    else:
+        response = send_from_directory(directory, name)
+    response.vary.add('Accept-Encoding')
+    return response
+
+
+def get_participants(codeversion, columns=PARTICIPANT_COLUMNS):
+    return iter_participants(
+        columns,
+        codeversion=codeversion,
+        # statuses=[COMPLETED, SUBMITTED, CREDITED, BONUSED],  # only take completed
+    )
+
+
+
+
+#----------------------------------------------
+# condition assignment
+#----------------------------------------------
+# psiTurk counts finished participants, plus unfinished ones who started within the
+# last cutoff_time minutes. Everyone else (returned, abandoned, quit early) gives up
+# their slot.
+FINISHED = [COMPLETED, CREDITED, SUBMITTED, BONUSED]
+UNFINISHED = [NOT_ACCEPTED, ALLOCATED, STARTED, QUITEARLY]
+
+# For finding the participants to expire (see expire_condition_counts) without a scan.
+participant_sweep_index = Index(
+    'ix_participants_condition_sweep',
+    Participant.codeversion, Participant.mode, Participant.status, Participant.beginhit)
+
+
+class ConditionCount(Base):
+    """
+    Number of participants assigned to each condition. psiTurk's default condition
+    picking counts the participants table for every new participant; we instead keep
+    the counts here and update them as we go, so assignment doesn't slow down as the
+    study fills up.
+
+    The counts follow psiTurk's rule: a new participant adds one to their condition,
+    and expire_condition_counts takes them off again once they have been unfinished
+    for cutoff_time minutes. Quitting early doesn't free the slot sooner, just as in
+    psiTurk. If an expired participant finishes after all, /complete counts them again.
+    """
+    __tablename__ = 'condition_counts'
+
+    codeversion = Column(String(128), primary_key=True)
+    mode = Column(String(128), primary_key=True)
+    cond = Column(Integer, primary_key=True)
+    counterbalance = Column(Integer, primary_key=True)
+    count = Column(Integer, nullable=False, default=0)
+
+
+class ConditionSweep(Base):
+    """
+    Participants of this codeversion and mode who began at or before expired_through
+    and were unfinished then have been taken off the condition counts.
+    """
+    __tablename__ = 'condition_sweeps'
+
+    codeversion = Column(String(128), primary_key=True)
+    mode = Column(String(128), primary_key=True)
+    expired_through = Column(DateTime, nullable=False)
+
+
+def init_app(app):
+    """
+    psiTurk calls this after registering our blueprint. create_all only makes indexes
+    along with new tables, so we add ours to an existing participants table here.
+    """
+    init_db()
+    engine = db_session.get_bind()
+    existing = {index['name'] for index in inspect(engine).get_indexes(Participant.__tablename__)}
+    if participant_sweep_index.name not in existing:
+        participant_sweep_index.create(bind=engine)
+
+
+def _condition_counts(codeversion, mode):
+    rows = (
+        ConditionCount.query
+        .filter(ConditionCount.codeversion == codeversion, ConditionCount.mode == mode)
+        .with_entities(ConditionCount.cond, ConditionCount.counterbalance, ConditionCount.count)
         .all()
     )
+    return {(cond, counter): count for cond, counter, count in rows}
+
+
+def _add_to_count(codeversion, mode, cond, counter, n, expected=None):
+    """
+    Adds n to a count. With `expected`, only if the count still is that, so the
+    check and the update are one atomic statement. Returns whether it changed.
+    """
+    query = ConditionCount.query.filter(
+        ConditionCount.codeversion == codeversion, ConditionCount.mode == mode,
+        ConditionCount.cond == cond, ConditionCount.counterbalance == counter)
+    if expected is not None:
+        query = query.filter(ConditionCount.count == expected)
+    return query.update({ConditionCount.count: ConditionCount.count + n}, synchronize_session=False) > 0
+
+
+def _cutoff():
+    cutofftime = datetime.timedelta(minutes=-config.getint('Task Parameters', 'cutoff_time'))
+    return datetime.datetime.now(datetime.timezone.utc) + cutofftime
+
+
+def rebuild_condition_counts(codeversion, mode):
+    """
+    (Re)initializes the counts from the participants table, counting participants the way
+    psiTurk does: those that finished, plus those that started within the last `cutoff_time` minutes.
+    This scans the participants table, so we only do it once per codeversion and mode.
+    """
+    numconds = config.getint('Task Parameters', 'num_conds')
+    numcounts = config.getint('Task Parameters', 'num_counters')
+    starttime = _cutoff()
+
+    counts = {(cond, counter): 0 for cond in range(numconds) for counter in range(numcounts)}
+    rows = (
+        Participant.query
+        .filter(Participant.codeversion == codeversion, Participant.mode == mode)
+        .filter(or_(Participant.status.in_(FINISHED),
+                    Participant.beginhit > starttime))
+        .group_by(Participant.cond, Participant.counterbalance)
+        .with_entities(Participant.cond, Participant.counterbalance, func.count())
+    )
+    for cond, counter, count in rows:
+        if (cond, counter) in counts:
+            counts[cond, counter] = count
+
+    ConditionCount.query.filter(ConditionCount.codeversion == codeversion, ConditionCount.mode == mode).delete()
+    ConditionSweep.query.filter(ConditionSweep.codeversion == codeversion, ConditionSweep.mode == mode).delete()
+    db_session.add_all([
+        ConditionCount(codeversion=codeversion, mode=mode, cond=cond, counterbalance=counter, count=count)
+        for (cond, counter), count in counts.items()
+    ])
+    db_session.add(ConditionSweep(codeversion=codeversion, mode=mode, expired_through=starttime))
+    try:
+        db_session.commit()
+    except IntegrityError:
+        # Another worker initialized the counts at the same time; we use theirs.
+        db_session.rollback()
+    return _condition_counts(codeversion, mode)
+
+
+def expire_condition_counts(codeversion, mode):
+    """
+    Takes participants who have been unfinished for cutoff_time minutes off the counts.
+    Each sweep only looks at participants who began since the previous one, so this is
+    a range over participant_sweep_index rather than a scan. Returns False if the counts
+    haven't been built yet.
+    """
+    sweep = (
+        ConditionSweep.query
+        .filter(ConditionSweep.codeversion == codeversion, ConditionSweep.mode == mode)
+        .with_entities(ConditionSweep.expired_through)
+        .one_or_none()
+    )
+    if sweep is None:
+        return False
+    previous, = sweep
+    starttime = _cutoff()
+    rows = (
+        Participant.query
+        .filter(Participant.codeversion == codeversion, Participant.mode == mode,
+                Participant.status.in_(UNFINISHED),
+                Participant.beginhit > previous, Participant.beginhit <= starttime)
+        .group_by(Participant.cond, Participant.counterbalance)
+        .with_entities(Participant.cond, Participant.counterbalance, func.count())
+        .all()
+    )
+    # Moving the watermark only succeeds for one of several workers sweeping at once,
+    # so nobody is expired twice.
+    claimed = (
+        ConditionSweep.query
+        .filter(ConditionSweep.codeversion == codeversion, ConditionSweep.mode == mode,
+                ConditionSweep.expired_through == previous)
+        .update({ConditionSweep.expired_through: starttime}, synchronize_session=False)
+    )
+    if not claimed:
+        db_session.rollback()
+        return True
+    for cond, counter, count in rows:
+        _add_to_count(codeversion, mode, cond, counter, -count)
+    db_session.commit()
+    return True
+
+
+def recount_late_finisher(user):
+    """
+    Counts `user` again if they were expired from the counts before finishing, as
+    psiTurk counts every finished participant. Call this when they finish.
+    """
+    expired = (
+        ConditionSweep.query
+        .filter(ConditionSweep.codeversion == user.codeversion, ConditionSweep.mode == user.mode,
+                ConditionSweep.expired_through >= user.beginhit)
+        .count()
+    )
+    if expired:
+        _add_to_count(user.codeversion, user.mode, user.cond, user.counterbalance, 1)
+        db_session.commit()
+
 
+def custom_get_condition(mode, attempts=10):
+    """
+    psiTurk calls this to pick (condition, counterbalance) for each new participant.
+    We expire stale participants, take the least-used condition and increment its
+    count in place, which touches only the num_conds * num_counters rows of the
+    counts table plus the participants who started since the last sweep.
 
+    The increment only applies if the count is still the minimum we read, so two
+    workers assigning at once can't both fill the same slot; the loser reads the
+    counts again. We don't commit: psiTurk inserts the participant right after this
+    in the same transaction, so if that fails the increment is rolled back with it.
+    """
+    codeversion = config.get('Task Parameters', 'experiment_code_version')
+    if not expire_condition_counts(codeversion, mode):
+        rebuild_condition_counts(codeversion, mode)
+
+    for attempt in range(attempts):
+        counts = _condition_counts(codeversion, mode)
+        mincount = min(counts.values())
+        chosen = choice([key for key, count in counts.items() if count == mincount])
+        cond, counter = chosen
+        # After too many lost races we take the slot anyway, slightly unbalanced.
+        expected = mincount if attempt < attempts - 1 else None
+        if _add_to_count(codeversion, mode, cond, counter, 1, expected=expected):
+            break
+        db_session.rollback()
+    current_app.logger.info("given %(a)s chose %(b)s" % {'a': counts, 'b': chosen})
+    return chosen
+
+
+@custom_code.route('/condition_counts', methods=['GET', 'POST'])
+@myauth.requires_auth
+def condition_counts():
+    """
+    GET shows the current counts for a mode (default live), after expiring stale
+    participants. POST rebuilds them from the participants table.
+    """
+    codeversion = request.args.get('codeversion', config.get('Task Parameters', 'experiment_code_version'))
+    mode = request.args.get('mode', 'live')
+    if request.method == 'POST':
+        counts = rebuild_condition_counts(codeversion, mode)
+    else:
+        expire_condition_counts(codeversion, mode)
+        counts = _condition_counts(codeversion, mode)
+    return jsonify(codeversion=codeversion, mode=mode, counts=[
+        dict(cond=cond, counterbalance=counter, count=count)
+        for (cond, counter), count in sorted(counts.items())
+    ])
 
 
 #----------------------------------------------
@@ -118,47 +395,262 @@ def my_password_protected_route():
         abort(404)
 
 #----------------------------------------------
-# example accessing data
+# accessing data
 #----------------------------------------------
+def filtered_participants(args):
+    """
+    Participants (without datastrings) matching the codeversion, status and mode
+    given in `args`.
+    """
+    return query_participants(
+        codeversion=args.get('codeversion'),
+        statuses=args.getlist('status', type=int) if 'status' in args else None,
+        mode=args.get('mode'),
+    )
+
+
+MAX_PER_PAGE = 1000
+
+
+def _page_arg(args, name, default):
+    value = args.get(name)
+    if value is None:
+        return default
+    try:
+        value = int(value)
+    except ValueError:
+        value = 0
+    if value < 1:
+        raise InvalidUsage(f'{name} must be a positive integer', status_code=400)
+    return value
+
+
+def paginate(query, args, default_per_page):
+    """
+    Limits `query` to the page (counting from 1) of per_page rows given in `args`.
+    per_page is capped at MAX_PER_PAGE; anything but positive integers is a 400.
+    """
+    page = _page_arg(args, 'page', 1)
+    per_page = min(_page_arg(args, 'per_page', default_per_page), MAX_PER_PAGE)
+    return query.limit(per_page).offset((page - 1) * per_page), page, per_page
+
+
+def _jsonable(value):
+    return value.isoformat() if isinstance(value, datetime.datetime) else value
+
+
 @custom_code.route('/view_data')
 @myauth.requires_auth
 def list_my_data():
-    users = Participant.query.all()
+    query, page, per_page = paginate(filtered_participants(request.args), request.args, 100)
+    users = query.all()
+    args = request.args.to_dict(flat=False)
+    prev_url = url_for('.list_my_data', **dict(args, page=page - 1)) if page > 1 else None
+    next_url = url_for('.list_my_data', **dict(args, page=page + 1)) if len(users) == per_page else None
     try:
-        return render_template('list.html', participants=users)
+        return render_template('list.html', participants=users, page=page, prev_url=prev_url, next_url=next_url)
     except TemplateNotFound:
         abort(404)
 
+
+@custom_code.route('/api/participants')
+@myauth.requires_auth
+def participants_api():
+    """
+    Streams participants as NDJSON (default) or CSV (format=csv). Supports the
+    same filters as /view_data; pass page and/or per_page to get one page only.
+    """
+    query = filtered_participants(request.args)
+    if 'page' in request.args or 'per_page' in request.args:
+        query, _, _ = paginate(query, request.args, 1000)
+    fmt = request.args.get('format', 'ndjson')
+    rows = query.yield_per(500)
+
+    def ndjson():
+        for row in rows:
+            yield dumps({c: _jsonable(v) for c, v in zip(PARTICIPANT_COLUMNS, row)}) + '\n'
+
+    def csv_rows():
+        buf = io.StringIO()
+        writer = csv.writer(buf)
+        writer.writerow(PARTICIPANT_COLUMNS)
+        for row in rows:
+            writer.writerow([_jsonable(v) for v in row])
+            yield buf.getvalue()
+            buf.seek(0)
+            buf.truncate()
+        yield buf.getvalue()
+
+    if fmt == 'csv':
+        return Response(stream_with_context(csv_rows()), mimetype='text/csv')
+    elif fmt == 'ndjson':
+        return Response(stream_with_context(ndjson()), mimetype='application/x-ndjson')
+    else:
+        raise InvalidUsage(f'Unknown format {fmt}', status_code=400)
+
 #----------------------------------------------
-# example computing bonus
+# bonus
 #----------------------------------------------
+def latest_bonus(datastring):
+    """
+    The most recent `current_bonus` recorded by jspsych-CircleGraphNavigation.js, or None.
+    We scan backwards, so this usually only looks at the last few records. This runs
+    on every save, so malformed records are skipped rather than failing the save.
+    """
+    records = datastring.get('data') if isinstance(datastring, dict) else None
+    if not isinstance(records, list):
+        return None
+    for record in reversed(records):
+        trialdata = record.get('trialdata') if isinstance(record, dict) else None
+        bonus = trialdata.get('current_bonus') if isinstance(trialdata, dict) else None
+        if isinstance(bonus, (int, float)) and not isinstance(bonus, bool):
+            return bonus
+    return None
+
+
+@custom_code.route('/sync/<uid>', methods=['PUT'])
+def sync_and_record_bonus(uid=None):
+    """
+    Replaces psiTurk's PUT /sync, which saves the datastring. We also keep the
+    participant's running bonus up to date, so we never have to parse the
+    datastring again to compute it.
+    """
+    current_app.logger.info("PUT /sync route with id: %s" % uid)
+    user = Participant.query.filter(Participant.uniqueid == uid).one_or_none()
+    if user is None:
+        raise ExperimentApiError("DB error: Unique user not found.")
+
+    user.datastring = dumps(request.json)
+    bonus = latest_bonus(request.json)
+    if bonus is not None:
+        user.bonus = bonus
+    db_session.add(user)
+    db_session.commit()
+
+    trial = request.json.get("currenttrial", None) if isinstance(request.json, dict) else None
+    current_app.logger.info("saved data for %s (current trial: %s)", uid, trial)
+    return jsonify(status="user data saved")
+
+
+def fold_trial_records(user):
+    """
+    Writes the participant's appended trial records back into their datastring,
+    so that it is once again what psiTurk's PUT /sync would have saved. Does not
+    commit.
+    """
+    try:
+        data = loads(user.datastring)
+    except (ValueError, TypeError):
+        return
+    if isinstance(data, dict):
+        user.datastring = dumps(reconcile(user.uniqueid, data))
+
+
+@custom_code.route('/sync/<uid>/append', methods=['POST'])
+def append_data(uid=None):
+    """
+    Append-only alternative to PUT /sync, used by saveData in static/js/setup.js.
+    The client sends its datastring with `data` holding only the trial records
+    from index `start` on; we store those in trial_records and the (small) rest
+    in the datastring, and reply with the index of the next record we need.
+
+    Until the participant completes, their datastring has an empty `data` list,
+    so anything reading it before then (psiTurk's download_datafiles and
+    dashboard, say) must go through participant_queries.reconcile, as
+    fetch_data does. /complete folds the records back in (fold_trial_records),
+    and so does any save that comes in after that.
+    """
+    user = Participant.query.filter(Participant.uniqueid == uid).one_or_none()
+    if user is None:
+        raise ExperimentApiError("DB error: Unique user not found.")
+    payload = request.json
+    if not isinstance(payload, dict) or not isinstance(payload.get('start'), int) or not isinstance(payload.get('data'), list):
+        raise InvalidUsage('Expected start and data')
+    start = payload.pop('start')
+    records = payload.pop('data')
+
+    stored = appended_count(uid)
+    if start > stored:
+        # We are missing records in between, so ask for them again.
+        return jsonify(status="missing records", next=stored), 409
+    new = records[stored - start:]  # the client may resend records we already have
+    db_session.add_all(TrialRecord(uniqueid=uid, idx=idx, record=dumps(record))
+                       for idx, record in enumerate(new, stored))
+    payload['data'] = []
+    user.datastring = dumps(payload)
+    if user.status in FINISHED:
+        db_session.flush()
+        fold_trial_records(user)
+    bonus = latest_bonus({'data': new})
+    if bonus is not None:
+        user.bonus = bonus
+    try:
+        db_session.commit()
+    except IntegrityError:
+        # a concurrent request stored some of these already
+        db_session.rollback()
+        return jsonify(status="conflict", next=appended_count(uid)), 409
+
+    current_app.logger.info("appended %d records for %s", len(new), uid)
+    return jsonify(status="user data saved", next=stored + len(new))
+
+
+@custom_code.route('/sync/<uid>', methods=['GET'])
+def load_reconciled(uid=None):
+    """
+    Replaces psiTurk's GET /sync so that a reloaded page gets back the trial
+    records it saved through /sync/<uid>/append.
+    """
+    current_app.logger.info("GET /sync route with id: %s" % uid)
+    user = Participant.query.filter(Participant.uniqueid == uid).one_or_none()
+    if user is None:
+        raise ExperimentApiError("DB error: Unique user not found.")
+    try:
+        resp = reconcile(uid, loads(user.datastring))
+    except (ValueError, TypeError):
+        resp = {
+            "condition": user.cond,
+            "counterbalance": user.counterbalance,
+            "assignmentId": user.assignmentid,
+            "workerId": user.workerid,
+            "hitId": user.hitid,
+            "bonus": user.bonus
+        }
+    return jsonify(**resp)
+
 
 @custom_code.route('/compute_bonus', methods=['GET'])
 def compute_bonus():
     # check that user provided the correct keys
     # errors will not be that gracefull here if being
     # accessed by the Javascrip client
-    if not request.args.has_key('uniqueId'):
+    if 'uniqueId' not in request.args:
         raise ExperimentError('improper_inputs')  # i don't like returning HTML to JSON requests...  maybe should change this
     uniqueId = request.args['uniqueId']
 
-    try:
-        # lookup user in database
-        user = Participant.query.\
-               filter(Participant.uniqueid == uniqueId).\
-               one()
-        user_data = loads(user.datastring) # load datastring from JSON
-        bonus = 0
-
-        for record in user_data['data']: # for line in data file
-            trial = record['trialdata']
-            if trial['phase']=='TEST':
-                if trial['hit']==True:
-                    bonus += 0.02
-        user.bonus = bonus
-        db_session.add(user)
-        db_session.commit()
-        resp = {"bonusComputed": "success"}
-        return jsonify(**resp)
-    except:
+    # The bonus is kept up to date by /sync, so this is just a lookup by primary key.
+    bonus = (
+        Participant.query
+        .filter(Participant.uniqueid == uniqueId)
+        .with_entities(Participant.bonus)
+        .one_or_none()
+    )
+    if bonus is None:
         abort(404)  # again, bad to display HTML, but...
+    # Anyone can call this, so we don't reveal the amount; see /compute_bonus/all.
+    return jsonify(bonusComputed="success")
+
+
+@custom_code.route('/compute_bonus/all', methods=['GET'])
+@myauth.requires_auth
+def compute_bonus_all():
+    """
+    Bonuses of every participant in a codeversion (default: the current one).
+    """
+    codeversion = request.args.get('codeversion', config.get('Task Parameters', 'experiment_code_version'))
+    rows = (
+        Participant.query
+        .filter(Participant.codeversion == codeversion)
+        .with_entities(Participant.uniqueid, Participant.bonus)
+    )
+    return jsonify(codeversion=codeversion, bonuses={uniqueid: bonus for uniqueid, bonus in rows})
@@ -0,0 +1,102 @@
+# shared participant queries for custom.py and bin/fetch_data.py
+#
+# Participant rows carry the whole experiment datastring, which can be
+# megabytes per participant, so we never load full ORM objects here. Callers
+# name the columns they need and the filters run in SQL.
+
+import json
+import datetime
+from sqlalchemy import or_, and_, func, Column, Integer, String, Text
+from psiturk.models import Participant, Base  # import after setting DATABASE_URL
+
+# Everything but the datastring.
+PARTICIPANT_COLUMNS = [
+    'uniqueid', 'assignmentid', 'workerid', 'hitid', 'ipaddress', 'browser',
+    'platform', 'language', 'cond', 'counterbalance', 'codeversion',
+    'beginhit', 'beginexp', 'endhit', 'bonus', 'status', 'mode']
+
+
+def query_participants(columns=PARTICIPANT_COLUMNS, codeversion=None, statuses=None, mode=None, debug=True,
+                       changed_since=None, active_window=datetime.timedelta(days=1)):
+    """
+    Query for `columns` of the matching participants, ordered by uniqueid so
+    that pages are stable. With debug=False, participants whose uniqueid
+    contains "debug" are dropped. With changed_since (a datetime), only
+    participants who began or ended at or after then are kept, along with
+    those who haven't ended yet but began less than active_window before
+    changed_since (they may still be syncing data). Participants have no
+    last-modified time, so changes to a row that don't touch beginhit or endhit
+    (like status changes after endhit, or data saved later than that window)
+    are not picked up.
+    """
+    query = Participant.query.with_entities(*[getattr(Participant, c) for c in columns])
+    if codeversion is not None:
+        query = query.filter(Participant.codeversion == codeversion)
+    if statuses is not None:
+        query = query.filter(Participant.status.in_(statuses))
+    if mode is not None:
+        query = query.filter(Participant.mode == mode)
+    if not debug:
+        query = query.filter(~Participant.uniqueid.contains('debug'))
+    if changed_since is not None:
+        query = query.filter(or_(
+            Participant.beginhit >= changed_since,
+            Participant.endhit >= changed_since,
+            and_(Participant.endhit == None, Participant.beginhit >= changed_since - active_window),
+        ))
+    return query.order_by(Participant.uniqueid)
+
+
+def iter_participants(*args, batch_size=100, **kwargs):
+    """
+    Like query_participants, but fetches rows `batch_size` at a time instead of
+    all at once (a server-side cursor on postgres).
+    """
+    return query_participants(*args, **kwargs).yield_per(batch_size)
+
+
+#----------------------------------------------
+# append-only trial data
+#----------------------------------------------
+class TrialRecord(Base):
+    """
+    Trial records saved through POST /sync/<uid>/append (see custom.py), one row
+    per record in the order psiTurk created them. The rest of the datastring
+    (question data, events, ...) is small and stays in Participant.datastring,
+    whose `data` stays empty until the participant completes; use reconcile to
+    read an unfinished session's trials.
+    """
+    __tablename__ = 'trial_records'
+    uniqueid = Column(String(128), primary_key=True)
+    idx = Column(Integer, primary_key=True, autoincrement=False)
+    record = Column(Text, nullable=False)
+
+
+def appended_count(uniqueid):
+    """Number of trial records appended for uniqueid (they are contiguous from 0)."""
+    last = (
+        TrialRecord.query
+        .with_entities(func.max(TrialRecord.idx))
+        .filter(TrialRecord.uniqueid == uniqueid)
+        .scalar()
+    )
+    return 0 if last is None else last + 1
+
+
+def reconcile(uniqueid, data):
+    """
+    Adds appended trial records to `data` (a parsed datastring), giving what
+    psiTurk's PUT /sync would have saved. Records already in data['data'], e.g.
+    from a full PUT, are kept as they are.
+    """
+    trials = data.get('data') or []
+    records = (
+        TrialRecord.query
+        .with_entities(TrialRecord.record)
+        .filter(TrialRecord.uniqueid == uniqueid, TrialRecord.idx >= len(trials))
+        .order_by(TrialRecord.idx)
+        .all()
+    )
+    if records:
+        data['data'] = trials + [json.loads(record) for record, in records]
+    return data
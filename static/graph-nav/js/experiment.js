@@ -60,7 +60,7 @@ async function initializeExperiment() {
     width: 700,
     height: 600,
     scaleEdgeFactor: 1,
-    fixedXY: circleXY(config.trials.intro.graph.length)
+    fixedXY: config.fixedXY ?? circleXY(config.trials.intro.graph.length)
   };
 
   function instruct_block(name) {
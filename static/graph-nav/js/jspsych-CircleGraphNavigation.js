@@ -10,6 +10,12 @@ import jsPsych from '../../lib/jspsych-exported.js';
 import { bfs } from './graphs.js';
 
 const BLOCK_SIZE = 100;
+// Events are logged column-wise to keep datastrings small (most of them are
+// mouseenter/mouseleave): event holds indices into names, dt the ms since the
+// previous event, state the state id (-1 if none), and info the fields of events
+// that have more than a state, keyed by event index. decode_events in
+// bin/fetch_data.py expands them again.
+const EVENT_NAMES = ['mouseenter', 'mouseleave', 'visit', 'navigate', 'done']
 window.$ = $
 const colors = ["#00000"]
 // ["#E57373", "#64B5F6", "#81C784", "#FFF176"];
@@ -166,10 +172,10 @@ export class CircleGraph {
 
   setupLogging() {
     this.data = {
-      events: [],
+      events: {names: [...EVENT_NAMES], event: [], dt: [], state: [], info: {}},
       trial: _.pick(this.options, 'graph', 'n_steps', 'rewards', 'start', 'hover_edges', 'hover_rewards', 'trialNumber', 'bonus'),
     }
-    let start_time = Date.now()
+    let last_time = Date.now()
     this.logger = function (event, info = {}) {
       if (this.logger_callback) this.logger_callback(event, info)
       if (!event.startsWith('mouse')) {
@@ -178,11 +184,18 @@ export class CircleGraph {
 
 
       // console.log(event, info)
-      this.data.events.push({
-        time: Date.now() - start_time,
-        event,
-        ...info
-      });
+      const events = this.data.events
+      let code = events.names.indexOf(event)
+      if (code == -1) code = events.names.push(event) - 1
+      const { state = -1, ...rest } = info
+      // Events with other fields keep all of info (state included), so that
+      // decoding gives back the same key order.
+      if (!_.isEmpty(rest)) events.info[events.event.length] = info
+      const now = Date.now()
+      events.event.push(code)
+      events.dt.push(now - last_time)
+      events.state.push(state)
+      last_time = now
     }
   }
 
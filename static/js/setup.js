@@ -39,6 +39,11 @@ if (DEBUG) {
 // ---------- Initialize PsiTurk ---------- #
 psiturk = new PsiTurk(window.uniqueId, window.adServerLoc, window.mode);
 
+// Index of the first trial record the server hasn't acknowledged. saveData only
+// sends records from here on (see /sync/<uid>/append in custom.py), so saves
+// don't grow with the length of the session.
+let syncedTrials = 0;
+
 saveData = function() {
   console.log(Date.now(), 'saveData(): Start.');
   return new Promise(function(resolve, reject) {
@@ -52,18 +57,29 @@ saveData = function() {
       console.log(Date.now(), 'saveData(): Timeout.');
       return reject(new Error('timeout'));
     }, 60000);
-    return psiturk.saveData({
-      error: function(model, response, options) {
+    const taskdata = psiturk.taskdata;
+    const data = taskdata.get('data');
+    return $.ajax({
+      url: `/sync/${taskdata.id}/append`,
+      type: 'POST',
+      contentType: 'application/json',
+      data: JSON.stringify({...taskdata.toJSON(), start: syncedTrials, data: data.slice(syncedTrials)}),
+      error: function(response) {
         clearTimeout(timeout);
         console.log(Date.now(), 'saveData(): Error saving data!');
+        if (response.responseJSON && response.responseJSON.next !== undefined) {
+          // the server is missing records; the next save will resend them
+          syncedTrials = response.responseJSON.next;
+        }
         const e = new Error(`Error saving data. status: ${response.status}, statusText: ${response.statusText}`);
         for (const key of ['readyState', 'responseText', 'status', 'statusText']) {
           e[key] = response[key];
         }
         return reject(e);
       },
-      success: function() {
+      success: function(response) {
         clearTimeout(timeout);
+        syncedTrials = response.next;
         console.log(Date.now(), 'saveData(): Success.');
         return resolve();
       }
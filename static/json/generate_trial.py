@@ -2,10 +2,21 @@ import networkx as nx
 import numpy as np
 import random
 import json
+import math
 import os
+import gzip
+import hashlib
+import shutil
+import sys
+import configparser
+import multiprocessing
 import matplotlib.pyplot as plt
 import scipy
 from scipy.stats import rv_discrete
+from array import array
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'bin'))
+from circle_geometry import circle_geometry
 
 # Create a Python dictionary with None as a value
 data = {
@@ -42,7 +53,7 @@ def tree_join(g1, g2):
     n1 = len(g1)
     g1 = [[y + 1 for y in x] for x in g1]
     g2 = [[y + 1 + n1 for y in x] for x in g2]
-    return [[2, n1 + 2]] + g1 + g2
+    return [[1, n1 + 1]] + g1 + g2
 
 def random_tree(splits):
     if splits == 0:
@@ -54,6 +65,98 @@ def random_tree(splits):
     right = splits - 1 - left
     return tree_join(random_tree(left), random_tree(right))
 
+def inverse_permutation(perm):
+    """
+    Returns inv such that inv[perm[i]] == i, in linear time.
+    """
+    inv = [0] * len(perm)
+    for new, old in enumerate(perm):
+        inv[old] = new
+    return inv
+
+class Problem:
+    """
+    A problem with its graph in compressed sparse row form: the children of node i
+    are targets[offsets[i]:offsets[i+1]]. Rewards are a typed array, with NaN
+    standing in for rewards that are not shown (null in the JSON).
+
+    Indexing and iterating a Problem gives the children of each node, so it can be
+    used wherever we used the list-of-lists graph.
+    """
+    __slots__ = ('offsets', 'targets', 'rewards', 'start', 'n_steps', 'trialNumber')
+
+    def __init__(self, graph, rewards=None, start=0, n_steps=-1, trialNumber=None):
+        self.offsets = array('i', [0])
+        self.targets = array('i')
+        for children in graph:
+            self.targets.extend(children)
+            self.offsets.append(len(self.targets))
+        self.start = start
+        self.n_steps = n_steps
+        self.trialNumber = trialNumber
+        self.rewards = reward_array(rewards, len(graph))
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, node):
+        return self.targets[self.offsets[node]:self.offsets[node + 1]]
+
+    def __iter__(self):
+        for node in range(len(self)):
+            yield self[node]
+
+    @property
+    def graph(self):
+        return [list(children) for children in self]
+
+    def update(self, *, rewards=None, **kws):
+        """
+        Sets the given fields in place and returns the problem.
+        """
+        if rewards is not None:
+            self.rewards = reward_array(rewards, len(self))
+        for k, v in kws.items():
+            setattr(self, k, v)
+        return self
+
+    def relabel(self, perm):
+        """
+        Returns a copy where node perm[i] is renamed to i. Runs in time linear
+        in the number of nodes and edges.
+        """
+        inv = inverse_permutation(perm)
+        problem = Problem([], start=inv[self.start], n_steps=self.n_steps, trialNumber=self.trialNumber)
+        for old in perm:
+            problem.targets.extend(inv[child] for child in self[old])
+            problem.offsets.append(len(problem.targets))
+        problem.rewards = array('d', (self.rewards[old] for old in perm))
+        return problem
+
+    def to_json(self):
+        """
+        The representation experiment.js reads from the config.
+        """
+        rv = {
+            'graph': self.graph,
+            'rewards': [None if math.isnan(r) else int(r) if r.is_integer() else r for r in self.rewards],
+            'start': self.start,
+            'n_steps': self.n_steps,
+        }
+        if self.trialNumber is not None:
+            rv['trialNumber'] = self.trialNumber
+        return rv
+
+def reward_array(rewards, n):
+    if rewards is None:
+        rewards = [None] * n
+    return array('d', (math.nan if r is None else r for r in rewards))
+
+def json_default(obj):
+    if isinstance(obj, Problem):
+        return obj.to_json()
+    raise TypeError(f'Object of type {type(obj).__name__} is not JSON serializable')
+
 def valid_reward(n,rdist):
     """
     Ensures that the reward distribution has enough elements for sampling.
@@ -62,23 +165,123 @@ def valid_reward(n,rdist):
     while len(rdist.x) < n:
         rdist.x.append(0)
 
+def dp_order(problem):
+    """
+    Returns the nodes reachable from the start, with every node after all of its children.
+    Uses an explicit stack, so deep trees don't hit the recursion limit.
+    Raises a ValueError if a cycle is reachable, since paths to leaves aren't finite then.
+    """
+    order = []
+    state = {problem.start: 'open'}
+    stack = [(problem.start, iter(problem[problem.start]))]
+    while stack:
+        node, children = stack[-1]
+        for child in children:
+            if state.get(child) == 'open':
+                raise ValueError("Graph has a cycle, so paths must be limited with n_steps.")
+            if child not in state:
+                state[child] = 'open'
+                stack.append((child, iter(problem[child])))
+                break
+        else:
+            stack.pop()
+            state[node] = 'done'
+            order.append(node)
+    return order
+
 def paths(problem):
     """
     Returns all paths in the problem graph.
+    Paths from each node are computed once and shared by all of its parents.
+    """
+    memo = {}
+    for node in dp_order(problem):
+        children = problem[node]
+        if len(children) == 0:
+            memo[node] = [[]]
+        else:
+            memo[node] = [[child] + path for child in children for path in memo[child]]
+    return memo[problem.start]
+
+def iter_paths(problem, n_steps=-1):
     """
-    graph = problem['graph']
-    start = problem['start']
-    def rec(node):
-        if node == []:
-            return [[]]
+    Lazily yields the paths from the start, in the same order as paths(). A path ends at
+    a leaf, or after n_steps moves if n_steps != -1.
+    """
+    if n_steps == -1:
+        dp_order(problem)  # checks for cycles
+    path = []
+    stack = [iter(problem[problem.start])]
+    while stack:
+        child = next(stack[-1], None)
+        if child is None:
+            stack.pop()
+            if path:
+                path.pop()
+            continue
+        path.append(child)
+        if len(problem[child]) == 0 or len(path) == n_steps:
+            yield list(path)
+            path.pop()
         else:
-            paths = []
-            for child in node:
-                child_paths = rec(graph[child])
-                for path in child_paths:
-                    paths.append([child] + path)
-            return paths
-    return rec(graph[start])
+            stack.append(iter(problem[child]))
+    if len(problem[problem.start]) == 0:
+        yield []
+
+def _path_step(problem, reward, table, node):
+    children = problem[node]
+    if len(children) == 0:
+        return (1, 0, None)
+    count, best, best_child = 0, -math.inf, None
+    for child in children:
+        child_count, child_best, _ = table[child]
+        count += child_count
+        if reward[child] + child_best > best:
+            best, best_child = reward[child] + child_best, child
+    return (count, best, best_child)
+
+def path_table(problem, n_steps=-1):
+    """
+    Dynamic program over the paths from each node. Returns a function of (node, moves left)
+    giving (number of paths, best total reward, next node on a best path). Hidden rewards
+    count as 0. With n_steps == -1, paths run to a leaf and the moves left are ignored.
+    """
+    reward = [0 if math.isnan(r) else r for r in problem.rewards]
+    if n_steps == -1:
+        table = {}
+        for node in dp_order(problem):
+            table[node] = _path_step(problem, reward, table, node)
+        return lambda node, k: table[node]
+
+    layers = [{node: (1, 0, None) for node in range(len(problem))}]
+    for _ in range(n_steps):
+        layers.append({node: _path_step(problem, reward, layers[-1], node) for node in range(len(problem))})
+    return lambda node, k: layers[k][node]
+
+def count_paths(problem, n_steps=-1):
+    return path_table(problem, n_steps)(problem.start, n_steps)[0]
+
+def best_path(problem, n_steps=-1):
+    """
+    Returns (value, path) for a path from the start with the highest total reward.
+    """
+    table = path_table(problem, n_steps)
+    node, k = problem.start, n_steps
+    value = table(node, k)[1]
+    path = []
+    while table(node, k)[2] is not None:
+        node, k = table(node, k)[2], k - 1
+        path.append(node)
+    return value, path
+
+def default_problem_requirement(problem):
+    """
+    Same as in generate_trials.jl: there must be at least two paths to choose from.
+    """
+    n_steps = problem.n_steps
+    if n_steps == -1:
+        n_steps = len(problem)
+    return count_paths(problem, n_steps) >= 2
 
 def calculate_path_rewards(graph, rewards, start):
     """Calculate the sum of rewards for each path in the graph."""
@@ -97,40 +300,65 @@ def calculate_path_rewards(graph, rewards, start):
             path_rewards[path] = rewards[node] + rewards[child]
     return path_rewards
 
-def sample_requirement(rewards, graph, start, rdist, max_attempts=1000):
-    """Iteratively resample rewards until each path has a unique sum or maximum attempts are reached."""
-    for _ in range(max_attempts):
-        path_rewards = calculate_path_rewards(graph, rewards, start)
-        if len(set(path_rewards.values())) == len(path_rewards):
-            # Unique path rewards found
+def edge_pairs(graph, start):
+    """
+    Returns index arrays (u, v) with one entry for every edge that doesn't touch the start node.
+    Like calculate_path_rewards, each unordered pair of nodes is only counted once.
+    """
+    pairs = sorted({
+        tuple(sorted((node, child)))
+        for node, children in enumerate(graph) if node != start
+        for child in children if child != start
+    })
+    pairs = np.array(pairs, dtype=np.intp).reshape(-1, 2)
+    return pairs[:, 0], pairs[:, 1]
+
+def unique_edge_sums(rewards, u, v):
+    """
+    For a (batch, n) array of rewards, returns a boolean array marking the rows
+    where every edge (u[k], v[k]) has a different sum of rewards.
+    """
+    sums = np.sort(rewards[:, u] + rewards[:, v], axis=1)
+    return (np.diff(sums, axis=1) != 0).all(axis=1)
+
+def sample_requirement(rewards, graph, start, rdist, max_attempts=100000, batch_size=1000):
+    """
+    Resample rewards until each path has a unique sum. Candidates are drawn and checked
+    `batch_size` at a time; raises a ValueError if none of `max_attempts` candidates work.
+    """
+    u, v = edge_pairs(graph, start)
+    if rewards is not None:
+        if len(rewards) < len(graph):
+            raise ValueError("The length of rewards must be at least as large as the number of nodes in the graph")
+        if unique_edge_sums(np.array([rewards]), u, v)[0]:
             return rewards
-        rewards = rdist.rand()
 
-    # If max_attempts are reached without finding unique path rewards
-    return None  # or raise an exception
+    for attempt in range(0, max_attempts, batch_size):
+        candidates = rdist.rand_batch(min(batch_size, max_attempts - attempt))
+        valid = unique_edge_sums(candidates, u, v)
+        if valid.any():
+            return candidates[np.argmax(valid)].tolist()
+
+    raise ValueError(f"Can't sample rewards with unique path sums in {max_attempts} attempts!")
 
 def sample_graph(n,base=None):
     if base is None:
         base = [[1, 2], [3, 4], [5, 6]]
     base.extend([[] for i in range(n-len(base))])
     perm = random.sample(range(len(base)), len(base))
-    graph = []
-    for idx in perm:
-        graph.append([perm.index(i) for i in base[idx] if i != []])
-    start = perm.index(0)
-    return graph, perm, start
+    return Problem(base, start=0).relabel(perm), perm
 
 def sample_problem_1(n, trialNumber = None, n_steps=-1, rdist=None, rewards=None, graph=None, start=None):
     if graph is None:
-        graph, perm, start = sample_graph(n,base = [[1, 2], [3, 4],[5],[],[],[],[7,8],[8,9],[],[]])
+        problem, perm = sample_graph(n,base = [[1, 2], [3, 4],[5],[],[],[],[7,8],[8,9],[],[]])
     else:
-        perm = list(range(n))
+        problem, perm = Problem(graph, start=start), list(range(n))
     if rewards is None and rdist is not None:
         all_rewards = rdist.rand()
     if trialNumber is None:
         trialNumber = 0
 
-    all_rewards = sample_requirement(all_rewards, graph, start, rdist)
+    all_rewards = sample_requirement(all_rewards, problem, problem.start, rdist)
 
     # all_rewards = [0] * n
     #  # Assign rewards to non-leaf nodes, excluding the start node
@@ -144,7 +372,7 @@ def sample_problem_1(n, trialNumber = None, n_steps=-1, rdist=None, rewards=None
     # # Distribute rewards among non-leaf, non-start nodes
     # for rewards, node in zip(rewards, non_leaf_nodes):
     #     all_rewards[node] = rewards
-    return {'graph': graph, 'rewards': all_rewards, 'start': start, 'n_steps': n_steps, 'trialNumber': trialNumber}
+    return problem.update(rewards=all_rewards, n_steps=n_steps, trialNumber=trialNumber)
 
 def sample_problem_2(n, trialNumber = None, n_steps=-1, rdist=None, rewards=None, graph=None, start=None):
     """
@@ -152,15 +380,15 @@ def sample_problem_2(n, trialNumber = None, n_steps=-1, rdist=None, rewards=None
     Rewards are assigned only to non-leaf, non-start nodes.
     """
     if graph is None:
-        graph, perm, start = sample_graph(n,base = [[1, 2],[3, 4],[5,6],[],[],[],[],[8,9],[9],[]])
+        problem, perm = sample_graph(n,base = [[1, 2],[3, 4],[5,6],[],[],[],[],[8,9],[9],[]])
     else:
-        perm = list(range(n))
+        problem, perm = Problem(graph, start=start), list(range(n))
     if rewards is None and rdist is not None:
         all_rewards = rdist.rand()
     if trialNumber is None:
         trialNumber = 0
 
-    all_rewards = sample_requirement(all_rewards, graph, start, rdist)
+    all_rewards = sample_requirement(all_rewards, problem, problem.start, rdist)
     # all_rewards = [0] * n
     # # Assign rewards to non-leaf nodes, excluding the start node
     # non_leaf_nodes = set()
@@ -173,13 +401,13 @@ def sample_problem_2(n, trialNumber = None, n_steps=-1, rdist=None, rewards=None
     # for reward, node in zip(rewards, non_leaf_nodes):
     #     all_rewards[node] = reward
 
-    return {'graph': graph, 'rewards': all_rewards, 'start': start, 'n_steps': n_steps, 'trialNumber': trialNumber}
+    return problem.update(rewards=all_rewards, n_steps=n_steps, trialNumber=trialNumber)
 
 def sample_practice(n, trialNumber = None, n_steps=-1, rdist=None, rewards=None, graph=None, start=None):
     if graph is None:
-        graph, perm, start = sample_graph(n)
+        problem, perm = sample_graph(n)
     else:
-        perm = list(range(n))
+        problem, perm = Problem(graph, start=start), list(range(n))
     if rewards is None and rdist is not None:
         rewards = rdist.rand()
     if trialNumber is None:
@@ -190,27 +418,27 @@ def sample_practice(n, trialNumber = None, n_steps=-1, rdist=None, rewards=None,
     all_rewards = [None] * n
      # Assign rewards to non-leaf nodes, excluding the start node
     non_leaf_nodes = set()
-    for node, children in enumerate(graph):
-        if children and node != start:  # Exclude start node
+    for node, children in enumerate(problem):
+        if children and node != problem.start:  # Exclude start node
             non_leaf_nodes.add(node)
         for child in children:
-            if child != start:  # Exclude start node
+            if child != problem.start:  # Exclude start node
                 non_leaf_nodes.add(child)
     # Distribute rewards among non-leaf, non-start nodes
     for rewards, node in zip(rewards, non_leaf_nodes):
         all_rewards[node] = rewards
-    return {'graph': graph, 'rewards': all_rewards, 'start': start, 'n_steps': n_steps, 'trialNumber': trialNumber}
+    return problem.update(rewards=all_rewards, n_steps=n_steps, trialNumber=trialNumber)
 
 
 def learn_reward(n, n_steps=1, rdist=None, rewards=None, graph=None, start=None):
     if graph is None:
         base = [[1, 2]]
-        graph, perm, start = sample_graph(n,base)
+        problem, perm = sample_graph(n,base)
         # Ensuring that the start node has two children
-        if len(graph[start]) < 2:
+        if len(problem[problem.start]) < 2:
             raise ValueError("The start node must have at least two children.")
     else:
-        perm = list(range(n))  # No permutation if graph is already given
+        problem, perm = Problem(graph, start=start), list(range(n))  # No permutation if graph is already given
 
     if rewards is None and rdist is not None:
         while True:
@@ -222,11 +450,12 @@ def learn_reward(n, n_steps=1, rdist=None, rewards=None, graph=None, start=None)
     all_rewards = [None] * n
 
     # Assign rewards to the first two children of the start node
-    if len(graph[start]) >= 2:
-        all_rewards[graph[start][0]] = rewards[0]
-        all_rewards[graph[start][1]] = rewards[1]
+    children = problem[problem.start]
+    if len(children) >= 2:
+        all_rewards[children[0]] = rewards[0]
+        all_rewards[children[1]] = rewards[1]
 
-    return {'graph': graph, 'rewards': all_rewards, 'start': start, 'n_steps': n_steps}
+    return problem.update(rewards=all_rewards, n_steps=n_steps)
 
 
 # Example usage
@@ -234,10 +463,12 @@ def learn_reward(n, n_steps=1, rdist=None, rewards=None, graph=None, start=None)
 # problem = sample_problem(n=5)
 # print(result)
 
-def sample_problem(**kwargs):
+def sample_problem(requirement=default_problem_requirement, **kwargs):
     for i in range(10000):
         problem = sample_problem_1(**kwargs)
-        return problem
+        if requirement(problem):
+            return problem
+    raise ValueError("Can't sample a problem!")
    
 def discrete_uniform(v):
     probs = np.ones(len(v)) / len(v)
@@ -254,6 +485,10 @@ class Shuffler:
     def rand(self):
         random.shuffle(self.x)
         return self.x
+    def rand_batch(self, size):
+        """Returns a (size, len(x)) array, each row an independent shuffle of x."""
+        order = np.argsort(np.random.random((size, len(self.x))), axis=1)
+        return np.array(self.x)[order]
 
 class IIDSampler:
     def __init__(self, n, x):
@@ -264,13 +499,17 @@ class IIDSampler:
 
     def rand(self):
         return random.choices(self.x, k=self.n)
+
+    def rand_batch(self, size):
+        """Returns a (size, n) array, each row an independent draw of rand()."""
+        return np.random.choice(self.x, size=(size, self.n))
     
 def value(problem):
     """
     Calculate the total value of the problem, 
     presumably by summing the rewards.
     """
-    return sum(problem['rewards'])
+    return sum(r for r in problem.rewards if not math.isnan(r))
 
 import networkx as nx
 
@@ -293,7 +532,7 @@ def intro_problem(n, n_steps=-1, rdist=None, rewards=None, graph=None, start=Non
     elif len(rewards) > n:
         rewards = rewards[:n]  
     random.shuffle(rewards)
-    return {'graph': graph, 'rewards': rewards, 'start': start if start is not None else 0, 'n_steps': n_steps}
+    return Problem(graph, rewards, start if start is not None else 0, n_steps)
 
 def make_trials():
     n = 10
@@ -354,15 +593,22 @@ def reward_graphics(n = 5,rewards = [-20,-10,0,10,20]):
     fixed_rewards = [str(i) for i in rewards]  # convert numbers to strings
     return dict(zip(fixed_rewards, sample(emojis, n)))
 
-# Generate trials
-subj_trials = [make_trials() for _ in range(10)]
-
-# Directory setup
-dest = "static/json/config/"
-os.makedirs(dest, exist_ok=True)
+def subject_seed(seed, i):
+    """
+    Derives the seed for participant i from the seed of the whole run, so that
+    a single participant's config can be regenerated on its own.
+    """
+    digest = hashlib.sha256(f'{seed}:{i}'.encode()).digest()
+    return int.from_bytes(digest[:8], 'little')
 
-# Save trials as JSON
-for i, trials in enumerate(subj_trials, start=1):
+def make_subject(seed):
+    """
+    Generates the config for one participant. We reseed every source of randomness
+    used here, so the result only depends on `seed` (and not on which worker runs it).
+    """
+    random.seed(seed)
+    np.random.seed(seed % 2**32)
+    trials = make_trials()
     parameters = {
         "emojiGraphics": reward_graphics(),
         "hover_edges": False,
@@ -372,16 +618,99 @@ for i, trials in enumerate(subj_trials, start=1):
         "vary_transition": False,
         "fixed_rewards": True
     }
-    with open(f"{dest}/{i}.json", "w", encoding='utf-8') as file:
-        json.dump({"parameters": parameters, "trials": trials}, file, ensure_ascii=False)
+    # Precomputed layout, so the browser doesn't need to compute circleXY.
+    fixedXY = circle_geometry(len(trials['intro'])).xy.tolist()
+    return {"parameters": parameters, "trials": trials, "fixedXY": fixedXY}
 
-n = 10
-rewards = [-10,-20 , 0, 10, 20]
-rdist = IIDSampler(n, rewards)
-sampled_problem = sample_practice(n,rdist=rdist)
-print("Sampled problem:", sampled_problem)
+def generate_configs(subjects, seed, processes=None):
+    """
+    Yields (i, config) for each participant number i in `subjects`, in order.
+    Participants are spread across a process pool.
+    """
+    subjects = list(subjects)
+    seeds = [subject_seed(seed, i) for i in subjects]
+    processes = processes or os.cpu_count()
+    chunksize = max(1, len(seeds) // (4 * processes))
+    with multiprocessing.Pool(processes) as pool:
+        yield from zip(subjects, pool.imap(make_subject, seeds, chunksize=chunksize))
+
+def default_seed():
+    """
+    Like generate_trials.jl, we seed with the experiment version by default.
+    """
+    c = configparser.ConfigParser()
+    c.read('config.txt')
+    return c["Task Parameters"]["experiment_code_version"]
+
+def compressed_siblings(path, compress):
+    """
+    Writes pre-compressed copies of the file at `path` next to it (e.g. 1.json.gz),
+    for each format in `compress` ('gz' and/or 'br'). Copies in other formats are
+    removed, since they would be stale.
+    """
+    for ext in ['gz', 'br']:
+        if ext not in compress and os.path.exists(f'{path}.{ext}'):
+            os.remove(f'{path}.{ext}')
+    if 'gz' in compress:
+        with open(path, 'rb') as src, open(path + '.gz', 'wb') as raw:
+            # mtime=0 keeps the output byte-for-byte reproducible.
+            with gzip.GzipFile(fileobj=raw, mode='wb', mtime=0) as dst:
+                shutil.copyfileobj(src, dst)
+    if 'br' in compress:
+        import brotli  # optional: pip install brotli
+        compressor = brotli.Compressor()
+        with open(path, 'rb') as src, open(path + '.br', 'wb') as dst:
+            for chunk in iter(lambda: src.read(1 << 16), b''):
+                dst.write(compressor.process(chunk))
+            dst.write(compressor.finish())
+
+class ConfigWriter:
+    """
+    Writes participant configs to `dest` as they are generated, so only one
+    participant is held in memory at a time.
+
+    Every participant's problems are sampled afresh, so there is nothing to share
+    between their files. To shrink the download instead, `compress` also writes
+    pre-compressed siblings, which custom.py serves to browsers that accept them.
+    """
+    def __init__(self, dest, compress=()):
+        self.dest = dest
+        self.compress = compress
+        os.makedirs(dest, exist_ok=True)
+
+    def write(self, i, config):
+        path = os.path.join(self.dest, f"{i}.json")
+        with open(path, "w", encoding='utf-8') as file:
+            json.dump(config, file, ensure_ascii=False, default=json_default)
+        compressed_siblings(path, self.compress)
+
+def main(n, seed, dest, processes=None, only=None, compress=()):
+    subjects = only or range(1, n + 1)
+    writer = ConfigWriter(dest, compress=compress)
+    for i, config in generate_configs(subjects, seed, processes):
+        writer.write(i, config)
+
+
+if __name__ == '__main__':
+    from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter
+    parser = ArgumentParser(formatter_class=ArgumentDefaultsHelpFormatter)
+    parser.add_argument("-n", type=int, default=10, help="Number of participant configs to generate.")
+    parser.add_argument("--seed", default=None, help="Seed for the whole run. Defaults to experiment_code_version in config.txt.")
+    parser.add_argument("--dest", default="static/json/config/")
+    parser.add_argument("--processes", type=int, default=None, help="Size of the process pool. Defaults to the number of cores.")
+    parser.add_argument("--only", type=int, nargs="+", help="Only (re)generate these participant numbers.")
+    parser.add_argument("--compress", nargs="*", choices=["gz", "br"], default=[], help="Also write pre-compressed copies of each file (served by custom.py).")
+    args = parser.parse_args()
+
+    seed = args.seed if args.seed is not None else default_seed()
+    main(args.n, seed, args.dest, args.processes, args.only, args.compress)
 
 # Example usage
+# n = 10
+# rewards = [-10,-20 , 0, 10, 20]
+# rdist = IIDSampler(n, rewards)
+# sampled_problem = sample_practice(n,rdist=rdist)
+# print("Sampled problem:", sampled_problem)
 # trials = make_trials()
 # print(trials)
 